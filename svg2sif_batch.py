@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+svg2sif_batch.py
+Convert many SVG files to Synfig files in one process
+
+Usage: svg2sif_batch.py [options] file.svg ...
+
+Each file.svg is converted to file.sif next to it (file.sifz with
+--compression-level). The options are those of synfig_output.py.
+
+A pool of Inkscape processes is kept running in shell mode and reused for
+every document; --inkscape-workers=N (1 by default) converts N documents at
+a time (pass --inkscape-workers=0 to start Inkscape for each document
+instead). Inkscape 1.x does not run verbs in shell mode, so it is always
+started for each document.
+Like svg2sif_compare, this needs the Inkscape extension directory
+(inkex.py, simplepath.py, ...) on PYTHONPATH.
+
+Copyright (C) 2011 Nikita Kitaev
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+"""
+import os
+import sys
+import threading
+import Queue
+
+from inkex import errormsg
+from synfig_prepare import MalformedSVGError, shell_verbs_supported
+from synfig_output import SynfigExport
+
+def output_filename(filename, options):
+    """Return the name of the file that filename is converted to"""
+    if options.compression_level > 0:
+        extension = ".sifz"
+    else:
+        extension = ".sif"
+    return os.path.splitext(filename)[0] + extension
+
+def convert(filename, args, options):
+    """Convert a single file, returning False if it failed"""
+    e = SynfigExport()
+    try:
+        e.affect(args + ["--output-file=%s" % output_filename(filename, options), filename], output=False)
+    except MalformedSVGError, err:
+        errormsg("%s: %s" % (filename, err))
+        return False
+    return True
+
+def convert_all(filenames, args, options):
+    """Convert files from a number of threads, returning the number of failures"""
+    queue = Queue.Queue()
+    for filename in filenames:
+        queue.put(filename)
+    failed = []
+
+    def work():
+        while True:
+            try:
+                filename = queue.get_nowait()
+            except Queue.Empty:
+                return
+            if not convert(filename, args, options):
+                failed.append(filename)
+
+    threads = [threading.Thread(target=work) for i in range(max(1, options.inkscape_workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(failed)
+
+if __name__ == '__main__':
+    args = ["--inkscape-workers=1"]
+    filenames = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--"):
+            args.append(arg)
+        else:
+            filenames.append(arg)
+
+    if not filenames:
+        print __doc__.split("Copyright")[0].strip()
+        sys.exit(1)
+
+    # The options are the same for every file
+    options, _ = SynfigExport().OptionParser.parse_args(args)
+    if options.inkscape_workers > 0 and not shell_verbs_supported(options.inkscape):
+        errormsg("Inkscape does not run verbs in shell mode, starting it for each document")
+        args.append("--inkscape-workers=0")
+        options.inkscape_workers = 0
+
+    sys.exit(1 if convert_all(filenames, args, options) else 0)
+
+# vim: expandtab shiftwidth=4 tabstop=8 softtabstop=4 fileencoding=utf-8 textwidth=99
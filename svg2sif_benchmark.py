@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+svg2sif_benchmark.py
+Micro-benchmarks for the svg2sif exporter
+
+Usage: svg2sif_benchmark.py [benchmark ...]
+
+Runs all benchmarks if none are given. Like svg2sif_compare, this needs the
+Inkscape extension directory (inkex.py, simplepath.py, ...) on PYTHONPATH.
+
+Copyright (C) 2011 Nikita Kitaev
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+"""
+import os
+import sys
+import stat
+import time
+import tempfile
+
+from inkex import NSS, addNS, etree
+import simplepath
+import synfig_prepare
+import synfig_output
+
+benchmarks = []
+
+def benchmark(f):
+    """Register a benchmark function"""
+    benchmarks.append(f)
+    return f
+
+def timed(f, *args):
+    """Return the time (in seconds) taken by f(*args), and its result"""
+    start = time.time()
+    ret = f(*args)
+    return time.time() - start, ret
+
+def report(name, seconds, extra=""):
+    print "  %-32s %10.4f s  %s" % (name, seconds, extra)
+
+###### Synthetic documents ################################
+
+def synthetic_svg(num_paths, subpaths=1, segments=10):
+    """Build an SVG document with the given number of paths"""
+    root = etree.fromstring('<svg xmlns="%s" width="1024" height="768"/>' % NSS["svg"])
+    for i in range(num_paths):
+        path = etree.SubElement(root, addNS("path", "svg"))
+        path.set("id", "path%d" % i)
+        path.set("style", "fill:#ff0000;stroke:#000000")
+        path.set("d", synthetic_path_d(subpaths, segments))
+    return root.getroottree()
+
+def synthetic_path_d(subpaths, segments=10):
+    """Build path data with the given number of closed subpaths"""
+    d = []
+    for i in range(subpaths):
+        x = (i % 100) * 10.0
+        y = (i / 100) * 10.0
+        d.append("M %f %f" % (x, y))
+        for j in range(segments):
+            d.append("L %f %f" % (x + j, y + (j % 2) * 5.0))
+        d.append("Z")
+    return " ".join(d)
+
+###### Benchmarks #########################################
+
+@benchmark
+def hand_off():
+    """Document hand-off to Inkscape: pipe, RAM-backed file, temp file"""
+    # A stand-in for Inkscape that returns the document unchanged
+    fd, executable = tempfile.mkstemp(".sh")
+    os.write(fd, '#!/bin/sh\nif [ "$1" = "--pipe" ]; then exec cat; fi\n')
+    os.close(fd)
+    os.chmod(executable, stat.S_IRWXU)
+
+    document = synthetic_svg(2000, subpaths=5)
+
+    for hand_off in ["pipe", "shm", "file"]:
+        a = synfig_prepare.InkscapeActionGroup(document, executable=executable, hand_off=hand_off)
+        a.select_id("path0")
+        a.verb("ObjectToPath")
+        seconds, _ = timed(a.run_document)
+
+        # Bytes the action group actually handed to Inkscape and read back
+        if a.hand_off_used == "pipe":
+            via = "through pipes"
+        else:
+            via = "through files in %s" % a.hand_off_used
+        report(hand_off, seconds, "%d bytes written, %d bytes read %s" % (a.bytes_written, a.bytes_read, via))
+
+    os.remove(executable)
+
+@benchmark
+def fuse_subpaths():
+    """Fusing the subpaths of paths with 10, 1k and 100k subpaths"""
+    for subpaths in [10, 1000, 100000]:
+        path_d = synthetic_path_d(subpaths, segments=3)
+        path = etree.Element(addNS("path", "svg"))
+        path.set("d", path_d)
+        seconds, _ = timed(synfig_prepare.fuse_subpaths, path)
+        report("%d subpaths" % subpaths, seconds, "%d bytes of path data" % len(path_d))
+
+@benchmark
+def parse_path():
+    """Parsing multi-megabyte path data: simplepath.parsePath vs iter_path"""
+    segments = ["m 0.5,0.25"]
+    for i in range(100000):
+        segments.append("c 1.25,-2.5 3.125,4.0625 5.5,-1.75 s 2.5,1 3,-0.5 l 1e-1,2.5 h 3 v -4")
+    segments.append("z")
+    path_d = " ".join(segments)
+    size = "%d bytes of path data" % len(path_d)
+
+    seconds, _ = timed(simplepath.parsePath, path_d)
+    report("simplepath.parsePath", seconds, size)
+
+    def consume(path):
+        for segment in path:
+            pass
+    seconds, _ = timed(consume, synfig_prepare.iter_path(path_d))
+    report("iter_path", seconds, size)
+
+@benchmark
+def tangents():
+    """Tangent radii and angles of a 1M-vertex BLine: per vertex vs batched"""
+    bline = synfig_output.BLine()
+    for i in xrange(1000000):
+        x = (i % 1000) * 0.5
+        y = (i / 1000) * 0.5
+        bline.append(x - 0.25, y + (i % 7) * 0.125, x, y, x + 0.25, y - (i % 5) * 0.125, True)
+    vertices = "%d vertices" % len(bline)
+
+    def per_vertex(d, bline):
+        points = bline.points
+        for i in xrange(len(bline)):
+            tg1x, tg1y, x, y, tg2x, tg2y = points[6*i:6*i+6]
+            d._calc_radius(x, y, tg1x, tg1y)
+            d._calc_angle(x, y, tg1x, tg1y)
+            d._calc_radius(x, y, tg2x, tg2y)
+            d._calc_angle(x, y, tg2x, tg2y)-180.0
+    seconds, _ = timed(per_vertex, synfig_output.SynfigDocument(), bline)
+    report("per vertex", seconds, vertices)
+
+    bnumpy = synfig_output.bnumpy
+    synfig_output.bnumpy = False
+    seconds, _ = timed(bline.tangents)
+    report("batched", seconds, vertices)
+
+    synfig_output.bnumpy = bnumpy
+    if bnumpy:
+        seconds, _ = timed(bline.tangents)
+        report("batched (numpy)", seconds, vertices)
+
+def bline_elements(param, bline):
+    """Build a bline param value element by element, as build_param used to"""
+    el = etree.SubElement(param, "bline")
+    el.set("type", "bline_point")
+    el.set("loop", "true" if bline.loop else "false")
+    points = bline.points
+    tg1_radii, tg1_angles, tg2_radii, tg2_angles = bline.tangents()
+    for i in xrange(len(bline)):
+        composite = etree.SubElement(etree.SubElement(el, "entry"), "composite")
+        composite.set("type", "bline_point")
+        vector = etree.SubElement(etree.SubElement(composite, "point"), "vector")
+        etree.SubElement(vector, "x").text = str(points[6*i+2])
+        etree.SubElement(vector, "y").text = str(points[6*i+3])
+        etree.SubElement(etree.SubElement(composite, "width"), "real").set("value", "1.0")
+        etree.SubElement(etree.SubElement(composite, "origin"), "real").set("value", "0.5")
+        etree.SubElement(etree.SubElement(composite, "split"), "bool").set("value", "true" if bline.get_split(i) else "false")
+        for t, radius, angle in [("t1", tg1_radii[i], tg1_angles[i]), ("t2", tg2_radii[i], tg2_angles[i])]:
+            rc = etree.SubElement(etree.SubElement(composite, t), "radial_composite")
+            rc.set("type", "vector")
+            etree.SubElement(etree.SubElement(rc, "radius"), "real").set("value", str(radius))
+            etree.SubElement(etree.SubElement(rc, "theta"), "angle").set("value", str(angle))
+    return el
+
+@benchmark
+def bline_param():
+    """Serializing a 200k-vertex bline param: lxml elements vs string templates"""
+    bline = synfig_output.BLine(loop=True)
+    for i in xrange(200000):
+        x = (i % 1000) * 0.5
+        y = (i / 1000) * 0.5
+        bline.append(x - 0.25, y + (i % 7) * 0.125, x, y, x + 0.25, y - (i % 5) * 0.125, i % 3 == 0)
+    d = synfig_output.SynfigDocument()
+
+    def elements():
+        param = etree.Element("param")
+        bline_elements(param, bline)
+        return etree.tostring(param)
+    seconds, expected = timed(elements)
+    report("elements", seconds, "%.2f us per vertex" % (seconds / len(bline) * 1e6))
+
+    def templates():
+        param = etree.Element("param")
+        param.append(etree.fromstring(d.bline_xml(bline)))
+        return etree.tostring(param)
+    seconds, output = timed(templates)
+    report("templates", seconds, "%.2f us per vertex%s" % (seconds / len(bline) * 1e6,
+                                                           "" if output == expected else " (OUTPUT DIFFERS)"))
+
+    def region(defer_blines):
+        d = synfig_output.SynfigDocument(defer_blines=defer_blines, guids="counter")
+        layer = d.create_layer("region", "region", {"bline": bline})
+        chunks = []
+        d.write_layers(chunks.append, [layer])
+        return chunks[0]
+    seconds, expected = timed(region, False)
+    report("templates, region layer", seconds, "%.2f us per vertex" % (seconds / len(bline) * 1e6))
+    seconds, output = timed(region, True)
+    report("deferred, region layer", seconds, "%.2f us per vertex%s" % (seconds / len(bline) * 1e6,
+                                                                        "" if output == expected else " (OUTPUT DIFFERS)"))
+
+def scan_param(layer, name):
+    """Find a param by scanning the layer, as get_param and set_param used to"""
+    for param in layer.iterchildren():
+        if param.get("name") == name:
+            return param
+
+@benchmark
+def param_access():
+    """100 fades of 1000 outline layers: scanning for params vs the param index"""
+    d = synfig_output.SynfigDocument(guids="counter")
+    layers = [d.create_layer("outline", "outline%d" % i) for i in range(1000)]
+
+    def scanned():
+        for i in xrange(100):
+            for layer in layers:
+                scan_param(layer, "blend_method")
+                scan_param(layer, "amount")
+                scan_param(layer, "amount")
+    seconds, _ = timed(scanned)
+    report("scanned (lookups only)", seconds)
+
+    def fades():
+        for i in xrange(100):
+            d.op_fade(layers, 0.99)
+    seconds, _ = timed(fades)
+    report("op_fade", seconds)
+
+@benchmark
+def guids():
+    """Generating 1M GUIDs with each strategy"""
+    for strategy in synfig_output.SynfigDocument.guid_strategies:
+        d = synfig_output.SynfigDocument(guids=strategy)
+        def generate():
+            for i in xrange(1000000):
+                d.new_guid("region", "path%d" % (i % 1000), "color")
+        seconds, _ = timed(generate)
+        report(strategy, seconds)
+
+###### Main ###############################################
+
+if __name__ == '__main__':
+    selected = sys.argv[1:]
+    for f in benchmarks:
+        if selected and f.__name__ not in selected:
+            continue
+        print "%s: %s" % (f.__name__, f.__doc__)
+        f()
+
+# vim: expandtab shiftwidth=4 tabstop=8 softtabstop=4 fileencoding=utf-8 textwidth=99
@@ -160,6 +160,25 @@ layers["blur"].update({
         })
 
 
+###### Elidable parameters ################################
+# Parameters that Synfig itself defaults to the values above when they are
+# missing, so that compact output can leave them out
+elidable_composite = ["z_depth", "amount", "blend_method"]
+elidable_shape = elidable_composite + ["origin", "invert", "antialias", "feather"]
+
+elidable_params = {
+    "PasteCanvas": elidable_composite + ["origin"],
+    "circle": elidable_composite,
+    "rectangle": elidable_composite,
+    "region": elidable_shape,
+    "outline": elidable_shape,
+    "linear_gradient": elidable_composite,
+    "radial_gradient": elidable_composite,
+    # The blur layer blends "straight" by default
+    "blur": ["z_depth", "amount"]
+    }
+
+
 ###### Layer versions #####################################
 layer_versions = {
     "outline" : "0.2",
@@ -209,6 +228,8 @@ def paramType(layer, param, value=None):
         # Unknown layer, try to determine parameter type based on value
         if value is None:
             raise Exception, "No information for given layer"
+        if hasattr(value, "points") and hasattr(value, "loop"):
+            return "bline"
         if type(value) == int:
             return "integer"
         elif type(value) == float:
@@ -239,6 +260,12 @@ def defaultLayerVersion(layer):
     else:
         return layer_versions[None]
 
+def elidableLayerParams(layer):
+    if layer in elidable_params.keys():
+        return elidable_params[layer]
+    else:
+        return []
+
 def defaultLayerParams(layer):
     if layer in layers.keys():
         return layers[layer].copy()
@@ -19,27 +19,337 @@ You should have received a copy of the GNU General Public License
 along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
 """
+import os
+import re
 import sys
 import math
+import gzip
 import uuid
+import hashlib
+import shutil
+import tempfile
+import struct
+from array import array
 from copy import deepcopy
+from collections import OrderedDict
 
 import inkex
 from inkex import NSS, addNS, etree, errormsg
-import simplepath, simplestyle, simpletransform
+import simplestyle, simpletransform
 import cubicsuperpath
 
-from synfig_prepare import SynfigPrep, MalformedSVGError, get_dimension
+from synfig_prepare import SynfigPrep, MalformedSVGError, get_dimension, iter_path, fuse_path
+from synfig_prepare import cull_offcanvas, cull_occluded
+from synfig_prepare import split_attrib, clones_tag, canvas_attrib, replace_file
 import synfig_fileformat as sif
 
+try:
+    import numpy
+    bnumpy = True
+except ImportError:
+    bnumpy = False
+
 ###### Utility Classes ####################################
 class UnsupportedException(Exception):
     """When part of an element is not supported, this exception is raised to invalidate the whole element"""
     pass
 
+def tangent_angle(dx, dy):
+    """Calculate angle (in degrees) of a tangent given its offset from the vertex"""
+    if dx > 0 and dy > 0:
+        ag = math.pi + math.atan(dy/dx)
+    elif dx > 0 and dy < 0:
+        ag = math.pi + math.atan(dy/dx)
+    elif dx < 0 and dy < 0:
+        ag = math.atan(dy/dx)
+    elif dx < 0 and dy > 0:
+        ag = 2*math.pi + math.atan(dy/dx)
+    elif dx == 0 and dy > 0:
+        ag = -1*math.pi/2
+    elif dx == 0 and dy < 0:
+        ag = math.pi/2
+    elif dx == 0 and dy == 0:
+        ag = 0
+    elif dx < 0 and dy == 0:
+        ag = 0
+    elif dx > 0 and dy == 0:
+        ag = math.pi
+
+    return (ag*180)/math.pi
+
+def _tangents_numpy(dx, dy):
+    """Vectorized tangent radii and tangent_angle(), for arrays of offsets"""
+    # The power ufunc is called directly: "**2" would square, which can
+    # round differently from the pow() that Python uses for floats
+    radius = sif.tangent_scale * numpy.sqrt(numpy.power(dx, 2.0) + numpy.power(dy, 2.0))
+
+    # Same quadrant ladder as tangent_angle, so that angles stay identical
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        atan = numpy.arctan(dy/dx)
+    ag = numpy.select(
+        [(dx > 0) & (dy != 0),
+         (dx < 0) & (dy < 0),
+         (dx < 0) & (dy > 0),
+         (dx == 0) & (dy > 0),
+         (dx == 0) & (dy < 0),
+         (dx > 0) & (dy == 0)],
+        [math.pi + atan,
+         atan,
+         2*math.pi + atan,
+         -1*math.pi/2,
+         math.pi/2,
+         math.pi],
+        0.0)
+
+    return radius, (ag*180)/math.pi
+
+class BLine(object):
+    """A BLine, with its vertices stored in flat arrays
+
+    Vertex i is stored as the six values points[6*i:6*i+6], that is
+    tg1x, tg1y, x, y, tg2x, tg2y, and bit i of splits is set when the
+    tangents of the vertex are split.
+    """
+    __slots__ = ["points", "splits", "loop"]
+
+    def __init__(self, loop=False):
+        self.points = array("d")
+        self.splits = bytearray()
+        self.loop = loop
+
+    @staticmethod
+    def from_vertices(vertices, loop=False):
+        """Build a BLine from a list of [[tg1x, tg1y], [x, y], [tg2x, tg2y], split] vertices"""
+        bline = BLine(loop)
+        for tg1, pt, tg2, split in vertices:
+            bline.append(tg1[0], tg1[1], pt[0], pt[1], tg2[0], tg2[1], split)
+        return bline
+
+    def __len__(self):
+        return len(self.points) // 6
+
+    def append(self, tg1x, tg1y, x, y, tg2x, tg2y, split):
+        """Add a vertex to the end of the BLine"""
+        i = len(self.points) // 6
+        self.points.extend((tg1x, tg1y, x, y, tg2x, tg2y))
+        if i & 7 == 0:
+            self.splits.append(0)
+        if split:
+            self.splits[i >> 3] |= 1 << (i & 7)
+
+    def get_split(self, i):
+        return bool(self.splits[i >> 3] & (1 << (i & 7)))
+
+    def set_tangent1(self, i, x, y):
+        """Set the position of the first tangent handle of vertex i"""
+        self.points[6*i] = x
+        self.points[6*i+1] = y
+
+    def vertex(self, i):
+        """Return vertex i as [[tg1x, tg1y], [x, y], [tg2x, tg2y], split]"""
+        p = self.points[6*i:6*i+6]
+        return [[p[0], p[1]], [p[2], p[3]], [p[4], p[5]], self.get_split(i)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.vertex(i)
+
+    def transform(self, mtx):
+        """Apply a transformation matrix to all points, in place"""
+        a, b, c = mtx[0]
+        d, e, f = mtx[1]
+        p = self.points
+        if len(p) == 0:
+            return
+        if bnumpy:
+            # Work on a view of the array, in a single vectorized pass
+            pts = numpy.frombuffer(p, dtype=numpy.float64).reshape(-1, 2)
+            x = pts[:, 0].copy()
+            y = pts[:, 1].copy()
+            pts[:, 0] = a*x + b*y + c
+            pts[:, 1] = d*x + e*y + f
+            return
+        for i in xrange(0, len(p), 2):
+            x = p[i]
+            y = p[i+1]
+            p[i] = a*x + b*y + c
+            p[i+1] = d*x + e*y + f
+
+    def tangents(self):
+        """Return the radii and angles (in degrees) of all tangents, as Synfig stores them
+
+        The result is four lists of floats: tg1 radii, tg1 angles, tg2 radii
+        and tg2 angles, with one entry per vertex.
+        """
+        p = self.points
+        if len(p) == 0:
+            return [], [], [], []
+        if bnumpy:
+            pts = numpy.frombuffer(p, dtype=numpy.float64).reshape(-1, 6)
+            x = pts[:, 2]
+            y = pts[:, 3]
+            tg1_radius, tg1_angle = _tangents_numpy(pts[:, 0] - x, pts[:, 1] - y)
+            tg2_radius, tg2_angle = _tangents_numpy(pts[:, 4] - x, pts[:, 5] - y)
+            tg2_angle -= 180.0
+            return tg1_radius.tolist(), tg1_angle.tolist(), tg2_radius.tolist(), tg2_angle.tolist()
+
+        tg1_radius = []
+        tg1_angle = []
+        tg2_radius = []
+        tg2_angle = []
+        sqrt = math.sqrt
+        scale = sif.tangent_scale
+        for i in xrange(0, len(p), 6):
+            x = p[i+2]
+            y = p[i+3]
+            dx = p[i] - x
+            dy = p[i+1] - y
+            tg1_radius.append(scale * sqrt(dx**2 + dy**2))
+            tg1_angle.append(tangent_angle(dx, dy))
+            dx = p[i+4] - x
+            dy = p[i+5] - y
+            tg2_radius.append(scale * sqrt(dx**2 + dy**2))
+            tg2_angle.append(tangent_angle(dx, dy) - 180.0)
+        return tg1_radius, tg1_angle, tg2_radius, tg2_angle
+
+    def copy(self):
+        bline = BLine(self.loop)
+        bline.points = array("d", self.points)
+        bline.splits = bytearray(self.splits)
+        return bline
+
+class PathCache(object):
+    """A bounded LRU cache of converted paths, keyed on (path data, nodetypes, matrix)
+
+    Entries are stored as immutable strings, and every lookup returns newly
+    built BLines, so callers are free to modify the result. The cache can be
+    saved to and loaded from a file, so that it is shared between runs.
+
+    The file only holds strings with their lengths (see save()), so that
+    loading it cannot run code, and a damaged file is simply ignored.
+    """
+    version = "2" # Change to invalidate files written by older versions
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path_d, nodetypes, mtx, *extra):
+        """Return the key of a conversion of the given path data"""
+        h = hashlib.sha1()
+        h.update(path_d)
+        h.update(repr([nodetypes, mtx] + list(extra)))
+        return h.digest()
+
+    def get(self, key):
+        """Return a list of new BLines for the key, or None"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        self.entries[key] = entry
+        self.hits += 1
+
+        blines = []
+        for points, splits, loop in entry:
+            bline = BLine(loop)
+            bline.points.fromstring(points)
+            bline.splits = bytearray(splits)
+            blines.append(bline)
+        return blines
+
+    def put(self, key, blines):
+        """Store a list of BLines, evicting the least recently used entries if needed"""
+        self.entries.pop(key, None)
+        self.entries[key] = tuple([(b.points.tostring(), str(b.splits), b.loop) for b in blines])
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def header(self):
+        return "svg2sif path cache %s\n" % self.version
+
+    def load(self, filename):
+        """Add the entries saved in a file, if it exists"""
+        try:
+            stream = open(filename, "rb")
+        except IOError:
+            return
+        try:
+            if stream.readline() != self.header():
+                return
+            entries = []
+            try:
+                while True:
+                    key = stream.read(20)
+                    if not key:
+                        break
+                    entry = []
+                    for i in xrange(self._read_length(stream)):
+                        loop = self._read_string(stream) == "1"
+                        points = self._read_string(stream)
+                        splits = self._read_string(stream)
+                        if len(points) % 48 != 0 or len(splits) != (len(points) // 48 + 7) // 8:
+                            raise ValueError("Bad path cache entry")
+                        entry.append((points, splits, loop))
+                    entries.append((key, tuple(entry)))
+            except (ValueError, struct.error):
+                # A damaged file is treated as an empty cache
+                return
+        finally:
+            stream.close()
+
+        # Keep the most recently used entries
+        for key, entry in entries[-self.max_entries:]:
+            self.entries.setdefault(key, entry)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read_length(self, stream):
+        data = stream.read(4)
+        if len(data) != 4:
+            raise ValueError("Truncated path cache")
+        return struct.unpack("<I", data)[0]
+
+    def _read_string(self, stream):
+        length = self._read_length(stream)
+        data = stream.read(length)
+        if len(data) != length:
+            raise ValueError("Truncated path cache")
+        return data
+
+    def save(self, filename):
+        """Write the entries to a file, replacing it atomically
+
+        After a header line, each entry is written as its 20-byte key and
+        its number of BLines, followed by the loop flag, points and splits
+        of each BLine. Counts and strings are prefixed with their length,
+        as 32-bit little-endian integers.
+        """
+        fd, temp_path = tempfile.mkstemp(".tmp", dir=os.path.dirname(filename) or ".")
+        stream = os.fdopen(fd, "wb")
+        stream.write(self.header())
+        for key, entry in self.entries.iteritems():
+            stream.write(key)
+            stream.write(struct.pack("<I", len(entry)))
+            for points, splits, loop in entry:
+                for data in ("1" if loop else "0", points, splits):
+                    stream.write(struct.pack("<I", len(data)))
+                    stream.write(data)
+        stream.close()
+        replace_file(temp_path, filename)
+
 class SynfigDocument(object):
     """A synfig document, with commands for adding layers and layer parameters"""
-    def __init__(self, width=1024, height=768, name="Synfig Animation 1"):
+    def __init__(self, width=1024, height=768, name="Synfig Animation 1", defer_blines=False,
+                 guids="random", guid_seed="", compact=False, precision=None):
         self.root_canvas = etree.fromstring(
             """
 <canvas
@@ -59,13 +369,30 @@ class SynfigDocument(object):
 
         self.gradients = {}
         self.filters = {}
+        self.canvases = {}
+
+        # With defer_blines, bline entries are kept as XML strings until they
+        # are written, instead of being parsed into the tree
+        self.defer_blines = defer_blines
+        self.deferred = {}
+
+        self.set_guids(guids, guid_seed)
+
+        # Params of layers by name, see _param_index()
+        self.param_indexes = {}
+
+        # In compact mode, params that Synfig defaults to the same value are left out
+        self.compact = compact
+        self.set_precision(precision)
 
     ### Properties
 
     def get_root_canvas(self):
+        self.expand_deferred()
         return self.root_canvas
 
     def get_root_tree(self):
+        self.expand_deferred()
         return self.root_canvas.getroottree()
 
     def _update_viewbox(self):
@@ -105,9 +432,45 @@ class SynfigDocument(object):
 
     ### Public utility functions
 
-    def new_guid(self):
-        """Generate a new GUID"""
-        return uuid.uuid4().hex
+    guid_strategies = ["random", "counter", "hash"]
+
+    def set_guids(self, strategy, seed=""):
+        """Choose how GUIDs are generated
+
+        random  -- a random UUID for every GUID (the default)
+        counter -- a counter, following a prefix derived from the seed
+        hash    -- a hash of the seed, the context of the GUID (layer type,
+                   description and param name), and how many times that
+                   context was seen before
+
+        The counter and hash strategies give the same GUIDs every time
+        the same document is exported. Documents that are meant to be
+        combined should use different seeds.
+        """
+        if strategy not in self.guid_strategies:
+            raise ValueError, "Unknown GUID strategy %s" % (strategy)
+        self.guid_strategy = strategy
+        self.guid_seed = seed
+        self.guid_prefix = hashlib.sha1("svg2sif\0" + seed).hexdigest()[:16]
+        self.guid_counter = 0
+        self.guid_contexts = {}
+
+    def new_guid(self, *context):
+        """Generate a new GUID, see set_guids()
+
+        context -- strings that identify what the GUID is for (optional)
+        """
+        if self.guid_strategy == "counter":
+            self.guid_counter += 1
+            return "%s%016x" % (self.guid_prefix, self.guid_counter)
+        elif self.guid_strategy == "hash":
+            # Labels and ids may be unicode, with any characters
+            key = "\0".join([c.encode("utf-8") if isinstance(c, unicode) else str(c) for c in context])
+            count = self.guid_contexts.get(key, 0)
+            self.guid_contexts[key] = count + 1
+            return hashlib.sha1("%s\0%s\0%d" % (self.guid_seed, key, count)).hexdigest()[:32]
+        else:
+            return uuid.uuid4().hex
 
     ### Coordinate system conversions
 
@@ -138,10 +501,16 @@ class SynfigDocument(object):
 
         y = self.height - y
 
-        assert self.coor_svg2sif([x, y]) == vector, "sif to svg coordinate conversion error"
-
         return [x, y]
 
+    def svg2sif_matrix(self, mtx=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]):
+        """Return a matrix that applies mtx, then converts from SVG to Synfig units"""
+        width = self.width
+        height = self.height
+        svg2sif = [[1.0/sif.kux, 0.0, -width/2.0/sif.kux],
+                   [0.0, -1.0/sif.kux, height/2.0/sif.kux]]
+        return simpletransform.composeTransform(svg2sif, mtx)
+
     def list_coor_svg2sif(self, l):
         """Scan a list for coordinate pairs and convert them to Synfig units"""
         # If list has two numerical elements,
@@ -178,11 +547,15 @@ class SynfigDocument(object):
 
     def bline_coor_svg2sif(self, b):
         """Convert a BLine from SVG to Synfig coordinate units"""
-        self.list_coor_svg2sif(b["points"])
+        b.transform(self.svg2sif_matrix())
 
     def bline_coor_sif2svg(self, b):
         """Convert a BLine from Synfig to SVG coordinate units"""
-        self.list_coor_sif2svg(b["points"])
+        width = self.width
+        height = self.height
+        sif2svg = [[sif.kux, 0.0, width/2.0],
+                   [0.0, -sif.kux, height/2.0]]
+        b.transform(sif2svg)
 
     ### XML Builders -- private
     ###  used to create XML elements in the Synfig document
@@ -218,29 +591,68 @@ class SynfigDocument(object):
         return sif.tangent_scale * math.sqrt( (p2x-p1x)**2 + (p2y-p1y)**2 )
 
     def _calc_angle(self, p1x, p1y, p2x, p2y):
-        """Calculate angle (in radians) of a tangent given two points"""
-        dx = p2x-p1x
-        dy = p2y-p1y
-        if dx > 0 and dy > 0:
-            ag = math.pi + math.atan(dy/dx)
-        elif dx > 0 and dy < 0:
-            ag = math.pi + math.atan(dy/dx)
-        elif dx < 0 and dy < 0:
-            ag = math.atan(dy/dx)
-        elif dx < 0 and dy > 0:
-            ag = 2*math.pi + math.atan(dy/dx)
-        elif dx == 0 and dy > 0:
-            ag = -1*math.pi/2
-        elif dx == 0 and dy < 0:
-            ag = math.pi/2
-        elif dx == 0 and dy == 0:
-            ag = 0
-        elif dx < 0 and dy == 0:
-            ag = 0
-        elif dx > 0 and dy == 0:
-            ag = math.pi
-
-        return (ag*180)/math.pi
+        """Calculate angle (in degrees) of a tangent given two points"""
+        return tangent_angle(p2x-p1x, p2y-p1y)
+
+    # Templates for bline_xml, in the layout build_param used to create element by element
+    bline_templates = {
+        True: '<bline type="bline_point" loop="true">%s</bline>',
+        False: '<bline type="bline_point" loop="false">%s</bline>'
+        }
+    bline_entry_template = "".join([
+        '<entry><composite type="bline_point">',
+        '<point><vector><x>{real}</x><y>{real}</y></vector></point>',
+        '<width><real value="1.0"/></width>',
+        '<origin><real value="0.5"/></origin>',
+        '<split><bool value="{split}"/></split>',
+        '<t1><radial_composite type="vector">',
+        '<radius><real value="{real}"/></radius><theta><angle value="{real}"/></theta>',
+        '</radial_composite></t1>',
+        '<t2><radial_composite type="vector">',
+        '<radius><real value="{real}"/></radius><theta><angle value="{real}"/></theta>',
+        '</radial_composite></t2>',
+        '</composite></entry>'
+        ])
+
+    def set_precision(self, precision=None):
+        """Round coordinates, angles and other reals to this many significant digits
+
+        With None, they are written in full.
+        """
+        self.precision = precision
+        if precision is None:
+            self.real_format = "%s"
+        else:
+            self.real_format = "%%.%dg" % precision
+        self.bline_entry_templates = dict([(split,
+            self.bline_entry_template.format(real=self.real_format, split=split))
+            for split in ["true", "false"]])
+
+    def format_real(self, value):
+        """Format a real number, see set_precision()"""
+        return self.real_format % float(value)
+
+    def bline_xml(self, bline):
+        """Return the XML of a bline param value (without its guid)"""
+        return self.bline_templates[bline.loop == True] % self.bline_entries_xml(bline)
+
+    def bline_entries_xml(self, bline):
+        """Return the XML of the entries of a bline param value"""
+        points = bline.points
+        split_template = self.bline_entry_templates["true"]
+        smooth_template = self.bline_entry_templates["false"]
+        tg1_radii, tg1_angles, tg2_radii, tg2_angles = bline.tangents()
+
+        entries = []
+        for i in xrange(len(bline)):
+            if bline.get_split(i):
+                template = split_template
+            else:
+                template = smooth_template
+            entries.append(template % (points[6*i+2], points[6*i+3],
+                                       tg1_radii[i], tg1_angles[i], tg2_radii[i], tg2_angles[i]))
+
+        return "".join(entries)
 
     def build_param(self, layer, name, value, param_type="auto", guid=None):
         """Add a parameter node to a layer"""
@@ -248,6 +660,8 @@ class SynfigDocument(object):
             param = self.root_canvas.makeelement("param")
         else:
             param = etree.SubElement(layer, "param")
+            if layer in self.param_indexes:
+                self.param_indexes[layer][name] = param
         param.set("name", name)
 
         #Automatically detect param_type
@@ -260,16 +674,19 @@ class SynfigDocument(object):
 
         if param_type == "real":
             el = etree.SubElement(param, "real")
-            el.set("value", str(float(value)))
+            el.set("value", self.format_real(value))
         elif param_type == "integer":
             el = etree.SubElement(param, "integer")
             el.set("value", str(int(value)))
         elif param_type == "vector":
             el = etree.SubElement(param, "vector")
             x = etree.SubElement(el, "x")
-            x.text = str(float(value[0]))
+            x.text = self.format_real(value[0])
             y = etree.SubElement(el, "y")
-            y.text = str(float(value[1]))
+            y.text = self.format_real(value[1])
+        elif param_type == "angle":
+            el = etree.SubElement(param, "angle")
+            el.set("value", self.format_real(value))
         elif param_type == "color":
             el = etree.SubElement(param, "color")
             r = etree.SubElement(el, "r")
@@ -312,77 +729,29 @@ class SynfigDocument(object):
                 el.set("value", "%fs" % value)
             elif type(value) == str:
                 el.set("value", value)
+        elif param_type == "string":
+            el = etree.SubElement(param, "string")
+            el.text = value
         elif param_type == "bline":
-            el = etree.SubElement(param, "bline")
-            el.set("type", "bline_point")
-
-            # value is a bline (dictionary type), see path_to_bline_list
-            if value["loop"] == True:
-                el.set("loop", "true")
+            # value is a BLine, see path_to_bline_list
+            if not isinstance(value, BLine):
+                value = BLine.from_vertices(value["points"], value["loop"])
+
+            if self.defer_blines and len(value) > 0:
+                # The entries are only written out by the streaming writer,
+                # see write_layers()
+                el = etree.SubElement(param, "bline")
+                el.set("type", "bline_point")
+                el.set("loop", "true" if value.loop == True else "false")
+                el.append(self._defer_xml(self.bline_entries_xml(value)))
             else:
-                el.set("loop", "false")
-
-            for vertex in value["points"]:
-                x = float(vertex[1][0])
-                y = float(vertex[1][1])
-
-                tg1x = float(vertex[0][0])
-                tg1y = float(vertex[0][1])
-
-                tg2x = float(vertex[2][0])
-                tg2y = float(vertex[2][1])
-
-                tg1_radius = self._calc_radius(x, y, tg1x, tg1y)
-                tg1_angle = self._calc_angle(x, y, tg1x, tg1y)
-
-                tg2_radius = self._calc_radius(x, y, tg2x, tg2y)
-                tg2_angle = self._calc_angle(x, y, tg2x, tg2y)-180.0
-
-                if vertex[3]:
-                    split = "true"
-                else:
-                    split = "false"
-
-                entry = etree.SubElement(el, "entry")
-                composite = etree.SubElement(entry, "composite")
-                composite.set("type", "bline_point")
-
-                point = etree.SubElement(composite, "point")
-                vector = etree.SubElement(point, "vector")
-                etree.SubElement(vector, "x").text = str(x)
-                etree.SubElement(vector, "y").text = str(y)
-
-                width = etree.SubElement(composite, "width")
-                etree.SubElement(width, "real").set("value", "1.0")
-
-                origin = etree.SubElement(composite, "origin")
-                etree.SubElement(origin, "real").set("value", "0.5")
-
-                split_el = etree.SubElement(composite, "split")
-                etree.SubElement(split_el, "bool").set("value", split)
-
-                t1 = etree.SubElement(composite, "t1")
-                t2 = etree.SubElement(composite, "t2")
-
-                t1_rc = etree.SubElement(t1, "radial_composite")
-                t1_rc.set("type", "vector")
-
-                t2_rc = etree.SubElement(t2, "radial_composite")
-                t2_rc.set("type", "vector")
-
-                t1_r = etree.SubElement(t1_rc, "radius")
-                t2_r = etree.SubElement(t2_rc, "radius")
-                t1_radius = etree.SubElement(t1_r, "real")
-                t2_radius = etree.SubElement(t2_r, "real")
-                t1_radius.set("value", str(tg1_radius))
-                t2_radius.set("value", str(tg2_radius))
-
-                t1_t = etree.SubElement(t1_rc, "theta")
-                t2_t = etree.SubElement(t2_rc, "theta")
-                t1_angle = etree.SubElement(t1_t, "angle")
-                t2_angle = etree.SubElement(t2_t, "angle")
-                t1_angle.set("value", str(tg1_angle))
-                t2_angle.set("value", str(tg2_angle))
+                # The entries are written from templates, and parsed in one go
+                el = etree.fromstring(self.bline_xml(value))
+                param.append(el)
+        elif param_type == "canvas" and isinstance(value, basestring):
+            # value is the id of an exported canvas, see add_canvas()
+            param.set("use", ":%s" % value)
+            return param
         elif param_type == "canvas":
             el = etree.SubElement(param, "canvas")
             el.set("xres", "10.0")
@@ -397,8 +766,10 @@ class SynfigDocument(object):
 
         if guid:
             el.set("guid", guid)
+        elif layer is not None:
+            el.set("guid", self.new_guid(layer.get("type"), layer.get("desc"), name))
         else:
-            el.set("guid", self.new_guid())
+            el.set("guid", self.new_guid(name))
 
         return param
 
@@ -417,6 +788,10 @@ class SynfigDocument(object):
         """
         layer = self.build_layer(layer_type, desc, canvas, active, version)
         default_layer_params = sif.defaultLayerParams(layer_type)
+        if self.compact:
+            elidable_params = sif.elidableLayerParams(layer_type)
+        else:
+            elidable_params = []
 
         for param_name in default_layer_params.keys():
             param_type = default_layer_params[param_name][0]
@@ -430,6 +805,10 @@ class SynfigDocument(object):
             else:
                 param_guid = None
 
+            if param_name in elidable_params and param_guid is None \
+                    and param_value == default_layer_params[param_name][1]:
+                continue
+
             if param_value is not None:
                 self.build_param(layer, param_name, param_value, param_type, guid=param_guid)
 
@@ -454,19 +833,37 @@ class SynfigDocument(object):
         if param_type == "auto":
             param_type = sif.paramType(layer_type, name)
 
-        # Remove existing parameters with this name
-        existing = []
-        for param in layer.iterchildren():
-            if param.get("name") == name:
-                existing.append(param)
+        # Replace the existing parameter with this name
+        index = self._param_index(layer)
+        existing = index.get(name)
 
-        if len(existing) == 0:
+        if existing is None:
             self.build_param(layer, name, value, param_type, guid)
-        elif len(existing) > 1:
-            raise AssertionError, "Found multiple parameters with the same name"
         else:
             new_param = self.build_param(None, name, value, param_type, guid)
-            layer.replace(existing[0], new_param)
+            layer.replace(existing, new_param)
+            index[name] = new_param
+
+    def _param_index(self, layer):
+        """Return a dictionary of the params of a layer by name
+
+        The dictionary is built on first use, and kept up to date by
+        build_param() and set_param().
+        """
+        index = self.param_indexes.get(layer)
+        if index is not None:
+            return index
+
+        index = {}
+        for param in layer.iterchildren():
+            name = param.get("name")
+            if name is None:
+                continue
+            if name in index:
+                raise AssertionError, "Found multiple parameters with the same name"
+            index[name] = param
+        self.param_indexes[layer] = index
+        return index
 
     def set_params(self, layer, params={}, guids={}, modify_linked=False):
         """Set layer parameters
@@ -490,25 +887,165 @@ class SynfigDocument(object):
         name -- param name
         param_type -- parameter type (default "auto")
 
-        NOT FULLY IMPLEMENTED
+        Values are returned in the form build_param() takes them. Params
+        that were left out (see compact mode) have their default value,
+        and unknown params are None.
         """
         layer_type = layer.get("type")
         assert layer_type, "Layer does not have a type"
 
+        param = self._param_index(layer).get(name)
+        if param is None:
+            # Compact output leaves out params with default values
+            default_layer_params = sif.defaultLayerParams(layer_type)
+            if name in default_layer_params.keys():
+                return default_layer_params[name][1]
+            return None
+
         if param_type == "auto":
             param_type = sif.paramType(layer_type, name)
 
-        for param in layer.iterchildren():
-            if param.get("name") == name:
-                if param_type == "real":
-                    return float(param[0].get("value", "0"))
-                elif param_type == "integer":
-                    return int(param[0].get("integer", "0"))
-                else:
-                    raise Exception, "Getting this type of parameter not yet implemented"
+        if param.get("use") is not None:
+            if param_type == "canvas":
+                # An exported canvas, see add_canvas()
+                return param.get("use").lstrip(":")
+            raise Exception, "Getting linked parameters is not supported"
+
+        el = param[0]
+        if param_type == "real":
+            return float(el.get("value", "0"))
+        elif param_type == "integer":
+            return int(el.get("value", "0"))
+        elif param_type == "angle":
+            return float(el.get("value", "0"))
+        elif param_type == "vector":
+            return [float(el.findtext("x", "0")), float(el.findtext("y", "0"))]
+        elif param_type == "color":
+            return [float(el.findtext(c, "0")) for c in ["r", "g", "b", "a"]]
+        elif param_type == "gradient":
+            stops = {}
+            for color in el.iterchildren("color"):
+                stops[float(color.get("pos"))] = [float(color.findtext(c, "0")) for c in ["r", "g", "b", "a"]]
+            return stops
+        elif param_type == "bool":
+            return el.get("value") == "true"
+        elif param_type == "time":
+            return el.get("value")
+        elif param_type == "string":
+            return el.text or ""
+        elif param_type == "bline":
+            return self._parse_bline(el)
+        elif param_type == "canvas":
+            return list(el)
+        else:
+            raise AssertionError, "Unsupported param type %s" % (param_type)
+
+    def _parse_bline(self, el):
+        """Build a BLine from a bline param value (to within rounding)"""
+        entries = el
+        if len(el) > 0 and el[0].tag is etree.Comment:
+            # The entries are deferred, see build_param()
+            key = el[0].text[len(self.deferred_prefix):]
+            if key not in self.deferred:
+                raise AssertionError, "Bline entries were already written"
+            entries = etree.fromstring("<x>%s</x>" % self.deferred[key])
+
+        bline = BLine(el.get("loop") == "true")
+        for composite in entries.iterfind("entry/composite"):
+            x = float(composite.findtext("point/vector/x"))
+            y = float(composite.findtext("point/vector/y"))
+
+            # Inverse of _calc_radius and _calc_angle
+            tangents = []
+            for t in ["t1", "t2"]:
+                radius = float(composite.find(t + "/radial_composite/radius/real").get("value"))
+                angle = math.radians(float(composite.find(t + "/radial_composite/theta/angle").get("value")))
+                radius /= sif.tangent_scale
+                tangents.append((radius * math.cos(angle), radius * math.sin(angle)))
+
+            bline.append(x - tangents[0][0], y - tangents[0][1],
+                         x, y,
+                         x + tangents[1][0], y + tangents[1][1],
+                         composite.find("split/bool").get("value") == "true")
+        return bline
 
     ### Global defs, and related
 
+    # Exported canvases
+    def add_canvas(self, canvas_id, layers):
+        """Export a canvas with the given layers in the document's defs
+
+        PasteCanvas layers can then use it by passing canvas_id as their canvas param.
+        """
+        defs = self.root_canvas.find("defs")
+        if defs is None:
+            defs = self.root_canvas.makeelement("defs")
+            name = self.root_canvas.find("name")
+            self.root_canvas.insert(self.root_canvas.index(name) + 1, defs)
+
+        canvas = etree.SubElement(defs, "canvas")
+        canvas.set("id", canvas_id)
+        for layer in layers:
+            canvas.append(layer)
+        self.canvases[canvas_id] = canvas
+
+    def has_canvas(self, canvas_id):
+        return canvas_id in self.canvases
+
+    ### Streaming output
+    ###  The root canvas only holds its name and defs, and layers are written as they come
+
+    def write_start(self, write):
+        """Write the root canvas up to its first layer, with the given write function"""
+        canvas = self._tostring(self.root_canvas)
+        assert canvas.endswith("</canvas>"), "Root canvas is empty"
+        write(canvas[:-len("</canvas>")])
+        self.deferred.clear()
+        self.param_indexes.clear()
+
+    def write_layers(self, write, layers):
+        """Write layers at the end of the root canvas"""
+        for layer in layers:
+            write(self._tostring(layer))
+        # Layers are written once, so their deferred XML and param indexes
+        # are no longer needed
+        self.deferred.clear()
+        self.param_indexes.clear()
+
+    ### Deferred XML
+    ###  Placeholder comments in the tree, replaced by XML strings on output
+
+    deferred_prefix = "svg2sif-deferred "
+    deferred_re = re.compile("<!--%s([0-9]+)-->" % deferred_prefix)
+
+    def _defer_xml(self, xml):
+        """Return a placeholder for the given XML string"""
+        key = str(len(self.deferred))
+        self.deferred[key] = xml
+        return etree.Comment(self.deferred_prefix + key)
+
+    def _tostring(self, el):
+        """Serialize an element, replacing placeholders with their XML"""
+        s = etree.tostring(el)
+        if self.deferred:
+            s = self.deferred_re.sub(lambda m: self.deferred[m.group(1)], s)
+        return s
+
+    def expand_deferred(self):
+        """Parse deferred XML into the tree, for callers that need the full tree"""
+        if not self.deferred:
+            return
+        for comment in list(self.root_canvas.iter(etree.Comment)):
+            if not comment.text.startswith(self.deferred_prefix):
+                continue
+            key = comment.text[len(self.deferred_prefix):]
+            parent = comment.getparent()
+            parent.remove(comment)
+            parent.extend(etree.fromstring("<x>%s</x>" % self.deferred[key]))
+
+    def write_end(self, write):
+        write("</canvas>")
+
     # SVG Filters
     def add_filter(self, filter_id, f):
         """Register a filter"""
@@ -526,7 +1063,7 @@ class SynfigDocument(object):
             }
         if stops != []:
             gradient["stops"] = stops
-            gradient["stops_guid"] = self.new_guid()
+            gradient["stops_guid"] = self.new_guid("gradient", gradient_id)
         elif link != "":
             gradient["link"] = link
         else:
@@ -545,7 +1082,7 @@ class SynfigDocument(object):
             }
         if stops != []:
             gradient["stops"] = stops
-            gradient["stops_guid"] = self.new_guid()
+            gradient["stops_guid"] = self.new_guid("gradient", gradient_id)
         elif link != "":
             gradient["link"] = link
         else:
@@ -858,47 +1395,45 @@ class SynfigDocument(object):
 
 def path_to_bline_list(path_d, nodetypes=None, mtx=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]):
     """
-    Convert a path to a BLine List
+    Convert a path (path data, or parsed path segments) to a BLine List
 
     bline_list format:
+    [ bline, bline, ...]
 
-    Vertex:
-    [[tg1x, tg1y], [x,y], [tg2x, tg2y], split = T/F]
-    Vertex list:
-    [ vertex, vertex, vertex, ...]
-    Bline:
-    {
-    "points"    : vertex_list,
-    "loop"      : True / False
-    }
+    where each bline is a BLine (see the BLine class).
+    """
+    return list(iter_blines(path_d, nodetypes, mtx))
+
+def iter_blines(path_d, nodetypes=None, mtx=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]):
+    """
+    Convert a path (path data, or parsed path segments) to BLines,
+    yielding each subpath as soon as it is complete
     """
 
     # Exit on empty paths
     if not path_d:
-        return []
+        return
 
-    # Parse the path
-    path = simplepath.parsePath(path_d)
+    # Parse the path as it is consumed
+    if isinstance(path_d, basestring):
+        path = iter_path(path_d)
+    else:
+        path = path_d
 
-    # Append (more than) enough c's to the nodetypes
+    # Missing nodetypes are treated as "c"
     if nodetypes is None:
         nt = ""
     else:
         nt = nodetypes
+    nt_len = len(nt)
+    nt_index = 0
 
-    for _ in range(len(path)):
-        nt += "c"
+    transform = mtx != [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
 
-    # Create bline list
+    # Create blines
     #     borrows code from cubicsuperpath.py
 
-    # bline_list := [bline, bline, ...]
-    # bline := {
-    #           "points":[vertex, vertex, ...],
-    #           "loop":True/False,
-    #          }
-
-    bline_list = []
+    bline = None
 
     subpathstart = []
     last = []
@@ -906,34 +1441,38 @@ def path_to_bline_list(path_d, nodetypes=None, mtx=[[1.0, 0.0, 0.0], [0.0, 1.0,
     lastsplit = True
     for s in path:
         cmd, params = s
-        if cmd != "M" and bline_list == []:
-            raise MalformedSVGError, "Bad path data: path doesn't start with moveto, %s, %s" % (s, path)
+        if cmd != "M" and bline is None:
+            raise MalformedSVGError, "Bad path data: subpath doesn't start with moveto, %s" % (s,)
         elif cmd == "M":
-            # Add previous point to subpath
+            # Finish the previous subpath
             if last:
-                bline_list[-1]["points"].append([lastctrl[:], last[:], last[:], lastsplit])
+                bline.append(lastctrl[0], lastctrl[1], last[0], last[1], last[0], last[1], lastsplit)
+            if bline is not None:
+                if transform:
+                    bline.transform(mtx)
+                yield bline
             # Start a new subpath
-            bline_list.append({"nodetypes":"", "loop":False, "points":[]})
+            bline = BLine()
             # Save coordinates of this point
-            subpathstart =  params[:]
-            last = params[:]
-            lastctrl = params[:]
-            lastsplit = False if nt[0] == "z" else True
-            nt = nt[1:]
+            subpathstart = params
+            last = params
+            lastctrl = params
+            lastsplit = nt_index >= nt_len or nt[nt_index] != "z"
+            nt_index += 1
         elif cmd == 'L':
-            bline_list[-1]["points"].append([lastctrl[:], last[:], last[:], lastsplit])
-            last = params[:]
-            lastctrl = params[:]
-            lastsplit = False if nt[0] == "z" else True
-            nt = nt[1:]
+            bline.append(lastctrl[0], lastctrl[1], last[0], last[1], last[0], last[1], lastsplit)
+            last = params
+            lastctrl = params
+            lastsplit = nt_index >= nt_len or nt[nt_index] != "z"
+            nt_index += 1
         elif cmd == 'C':
-            bline_list[-1]["points"].append([lastctrl[:], last[:], params[:2], lastsplit])
-            last = params[-2:]
+            bline.append(lastctrl[0], lastctrl[1], last[0], last[1], params[0], params[1], lastsplit)
+            last = params[4:6]
             lastctrl = params[2:4]
-            lastsplit = False if nt[0] == "z" else True
-            nt = nt[1:]
+            lastsplit = nt_index >= nt_len or nt[nt_index] != "z"
+            nt_index += 1
         elif cmd == 'Q':
-            q0 = last[:]
+            q0 = last
             q1 = params[0:2]
             q2 = params[2:4]
             x0 =     q0[0]
@@ -944,56 +1483,298 @@ def path_to_bline_list(path_d, nodetypes=None, mtx=[[1.0, 0.0, 0.0], [0.0, 1.0,
             y1 = 1./3*q0[1]+2./3*q1[1]
             y2 =           2./3*q1[1]+1./3*q2[1]
             y3 =                           q2[1]
-            bline_list[-1]["points"].append([lastctrl[:], [x0, y0], [x1, y1], lastsplit])
+            bline.append(lastctrl[0], lastctrl[1], x0, y0, x1, y1, lastsplit)
             last = [x3, y3]
             lastctrl = [x2, y2]
-            lastsplit = False if nt[0] == "z" else True
-            nt = nt[1:]
+            lastsplit = nt_index >= nt_len or nt[nt_index] != "z"
+            nt_index += 1
         elif cmd == 'A':
             arcp = cubicsuperpath.ArcToPath(last[:], params[:])
             arcp[ 0][0] = lastctrl[:]
             last = arcp[-1][1]
             lastctrl = arcp[-1][0]
-            lastsplit = False if nt[0] == "z" else True
-            nt = nt[1:]
-            for el in arcp[:-1]:
-                el.append(True)
-                bline_list[-1]["points"].append(el)
+            lastsplit = nt_index >= nt_len or nt[nt_index] != "z"
+            nt_index += 1
+            for tg1, pt, tg2 in arcp[:-1]:
+                bline.append(tg1[0], tg1[1], pt[0], pt[1], tg2[0], tg2[1], True)
         elif cmd == "Z":
-            if len(bline_list[-1]["points"]) == 0:
+            if len(bline) == 0:
                 # If the path "loops" after only one point
                 #  e.g. "M 0 0 Z"
-                bline_list[-1]["points"].append([lastctrl[:], last[:], last[:], False])
+                bline.append(lastctrl[0], lastctrl[1], last[0], last[1], last[0], last[1], False)
             elif last == subpathstart:
                 # If we are back to the original position
                 # merge our tangent into the first point
-                bline_list[-1]["points"][0][0] = lastctrl[:]
+                bline.set_tangent1(0, lastctrl[0], lastctrl[1])
             else:
                 # Otherwise draw a line to the starting point
-                bline_list[-1]["points"].append([lastctrl[:], last[:], last[:], lastsplit])
+                bline.append(lastctrl[0], lastctrl[1], last[0], last[1], last[0], last[1], lastsplit)
 
             # Clear the variables (no more points need to be added)
             last = []
             lastctrl = []
             lastsplit = True
 
-            # Loop the subpath
-            bline_list[-1]["loop"] = True
-
+            # Loop the subpath, and hand it over
+            bline.loop = True
+            if transform:
+                bline.transform(mtx)
+            yield bline
+            bline = None
 
     # Append final superpoint, if needed
     if last:
-        bline_list[-1]["points"].append([lastctrl[:], last[:], last[:], lastsplit])
+        bline.append(lastctrl[0], lastctrl[1], last[0], last[1], last[0], last[1], lastsplit)
+    if bline is not None:
+        if transform:
+            bline.transform(mtx)
+        yield bline
 
-    # Apply the transformation
-    if mtx != [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]:
-        for bline in bline_list:
-            for vertex in bline["points"]:
-                for pt in vertex:
-                    if type(pt) != bool:
-                        simpletransform.applyTransformToPoint(mtx, pt)
+### Path simplification
 
-    return bline_list
+def simplify_bline(bline, tolerance, corner_angle=30.0):
+    """
+    Return a simplified copy of a BLine, that stays within tolerance of it
+
+    The BLine is cut at its corners (vertices where the direction changes by
+    more than corner_angle degrees). Each run of segments between two corners
+    is then replaced by a single line, if it is straight enough, or by as
+    few cubic segments as possible, fitted as described in
+    "An Algorithm for Automatically Fitting Digitized Curves"
+    (Philip J. Schneider, Graphics Gems, 1990).
+    """
+    n = len(bline)
+    if n < 3 or tolerance <= 0:
+        return bline.copy()
+
+    p = bline.points
+    tg1 = [(p[6*i], p[6*i+1]) for i in xrange(n)]
+    pts = [(p[6*i+2], p[6*i+3]) for i in xrange(n)]
+    tg2 = [(p[6*i+4], p[6*i+5]) for i in xrange(n)]
+    loop = bline.loop
+
+    # Find the corners. The direction of a segment shorter than the tolerance
+    # is mostly noise (as in traced artwork), so its vertices are left to the fit.
+    cos_corner = math.cos(math.radians(corner_angle))
+    corners = []
+    for i in xrange(n):
+        if not loop and (i == 0 or i == n-1):
+            corners.append(i)
+            continue
+        prev_pt = pts[i-1]
+        next_pt = pts[(i+1) % n]
+        if (math.hypot(pts[i][0] - prev_pt[0], pts[i][1] - prev_pt[1]) < tolerance or
+            math.hypot(next_pt[0] - pts[i][0], next_pt[1] - pts[i][1]) < tolerance):
+            continue
+        d_in = _direction(pts[i], tg1[i]) or _direction(pts[i], prev_pt)
+        d_out = _direction(tg2[i], pts[i]) or _direction(next_pt, pts[i])
+        if d_in is None or d_out is None or d_in[0]*d_out[0] + d_in[1]*d_out[1] < cos_corner:
+            corners.append(i)
+    if not corners:
+        corners.append(0)
+    if loop:
+        corners.append(corners[0] + n)
+
+    # Fit each run between two corners, and join the fitted segments
+    tol2 = tolerance * tolerance
+    first = corners[0]
+    vertices = [[tg1[first], pts[first], tg2[first], True]]
+    for a, b in zip(corners[:-1], corners[1:]):
+        samples = [pts[a % n]]
+        for i in xrange(a, b):
+            j = (i+1) % n
+            bezier = (pts[i % n], tg2[i % n], tg1[j], pts[j])
+            if bezier[1] == bezier[0] and bezier[2] == bezier[3]:
+                steps = [0.5, 1.0]
+            else:
+                steps = [0.25, 0.5, 0.75, 1.0]
+            for t in steps:
+                samples.append(_bezier_point(bezier, t))
+
+        t_start = _direction(tg2[a % n], pts[a % n]) or _direction(samples[1], samples[0])
+        t_end = _direction(tg1[b % n], pts[b % n]) or _direction(samples[-2], samples[-1])
+        beziers = _fit_cubic(samples, t_start, t_end, tol2)
+        if len(beziers) < b - a:
+            for bezier in beziers:
+                vertices[-1][2] = bezier[1]
+                vertices.append([bezier[2], bezier[3], bezier[3], True])
+        else:
+            # Nothing to gain, keep the original segments
+            for i in xrange(a+1, b+1):
+                vertices[-1][2] = tg2[(i-1) % n]
+                vertices.append([tg1[i % n], pts[i % n], tg2[i % n], bline.get_split(i % n)])
+        vertices[-1][2] = tg2[b % n]
+        vertices[-1][3] = True
+
+    if loop:
+        # The last vertex is the first corner again
+        vertices[0][0] = vertices.pop()[0]
+
+    simplified = BLine(loop)
+    for v_tg1, v_pt, v_tg2, split in vertices:
+        simplified.append(v_tg1[0], v_tg1[1], v_pt[0], v_pt[1], v_tg2[0], v_tg2[1], split)
+    return simplified
+
+def _direction(p1, p0):
+    """Return the unit vector from p0 to p1, or None if they are the same point"""
+    dx = p1[0] - p0[0]
+    dy = p1[1] - p0[1]
+    length = math.sqrt(dx*dx + dy*dy)
+    if length == 0:
+        return None
+    return (dx/length, dy/length)
+
+def _bezier_point(bezier, t):
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = bezier
+    s = 1 - t
+    b0 = s*s*s
+    b1 = 3*s*s*t
+    b2 = 3*s*t*t
+    b3 = t*t*t
+    return (b0*x0 + b1*x1 + b2*x2 + b3*x3, b0*y0 + b1*y1 + b2*y2 + b3*y3)
+
+def _fit_cubic(samples, t_start, t_end, tol2):
+    """Return a list of cubic segments fitted to the samples (see simplify_bline)
+
+    t_start and t_end are unit tangents at the ends, both pointing into the
+    samples. tol2 is the square of the tolerance.
+    """
+    beziers = []
+
+    # Runs still to fit, as [first sample, last sample, t_start, t_end]
+    #  (an explicit stack, as traced paths can split very deeply)
+    stack = [[0, len(samples)-1, t_start, t_end]]
+    while stack:
+        lo, hi, t_start, t_end = stack.pop()
+        run = samples[lo:hi+1]
+        first = run[0]
+        last = run[-1]
+
+        # Lines are kept as lines
+        if len(run) == 2 or _line_error(run) <= tol2:
+            beziers.append((first, first, last, last))
+            continue
+        if t_start is None:
+            t_start = _direction(run[1], first) or (1.0, 0.0)
+        if t_end is None:
+            t_end = _direction(run[-2], last) or (-1.0, 0.0)
+
+        u = _chord_lengths(run)
+        bezier = _generate_bezier(run, u, t_start, t_end)
+        error, split = _max_error(run, u, bezier)
+
+        # When the fit is close, improve the parameterization and try again
+        if tol2 < error <= 4*tol2:
+            for i in range(4):
+                u = [_newton_step(bezier, pt, t) for pt, t in zip(run, u)]
+                bezier = _generate_bezier(run, u, t_start, t_end)
+                error, split = _max_error(run, u, bezier)
+                if error <= tol2:
+                    break
+
+        if error <= tol2:
+            beziers.append(bezier)
+            continue
+
+        # Split at the point of maximum error, with a smooth tangent there
+        t_center = _direction(run[split-1], run[split+1]) or t_start
+        stack.append([lo+split, hi, (-t_center[0], -t_center[1]), t_end])
+        stack.append([lo, lo+split, t_start, t_center])
+    return beziers
+
+def _line_error(samples):
+    """Return the largest squared distance of the samples to the chord"""
+    (x0, y0), (x1, y1) = samples[0], samples[-1]
+    dx = x1 - x0
+    dy = y1 - y0
+    length2 = dx*dx + dy*dy
+    error = 0.0
+    for x, y in samples:
+        if length2 == 0:
+            t = 0.0
+        else:
+            t = min(1.0, max(0.0, ((x-x0)*dx + (y-y0)*dy) / length2))
+        ex = x - (x0 + t*dx)
+        ey = y - (y0 + t*dy)
+        error = max(error, ex*ex + ey*ey)
+    return error
+
+def _chord_lengths(samples):
+    """Parameterize the samples by chord length, from 0 to 1"""
+    u = [0.0]
+    for i in xrange(1, len(samples)):
+        u.append(u[-1] + math.hypot(samples[i][0] - samples[i-1][0], samples[i][1] - samples[i-1][1]))
+    total = u[-1]
+    if total == 0:
+        return [float(i) / (len(u) - 1) for i in xrange(len(u))]
+    return [t / total for t in u]
+
+def _generate_bezier(samples, u, t_start, t_end):
+    """Least-squares fit of a cubic with fixed end points and end tangent directions"""
+    first = samples[0]
+    last = samples[-1]
+    c00 = c01 = c11 = x0 = x1 = 0.0
+    for (px, py), t in zip(samples, u):
+        s = 1 - t
+        b0 = s*s*s
+        b1 = 3*s*s*t
+        b2 = 3*s*t*t
+        b3 = t*t*t
+        a0 = (t_start[0]*b1, t_start[1]*b1)
+        a1 = (t_end[0]*b2, t_end[1]*b2)
+        c00 += a0[0]*a0[0] + a0[1]*a0[1]
+        c01 += a0[0]*a1[0] + a0[1]*a1[1]
+        c11 += a1[0]*a1[0] + a1[1]*a1[1]
+        tx = px - (first[0]*(b0+b1) + last[0]*(b2+b3))
+        ty = py - (first[1]*(b0+b1) + last[1]*(b2+b3))
+        x0 += a0[0]*tx + a0[1]*ty
+        x1 += a1[0]*tx + a1[1]*ty
+
+    det = c00*c11 - c01*c01
+    if det != 0:
+        alpha_start = (x0*c11 - c01*x1) / det
+        alpha_end = (c00*x1 - x0*c01) / det
+    else:
+        alpha_start = alpha_end = 0.0
+
+    # Fall back to a third of the chord when the fit is degenerate
+    chord = math.hypot(last[0] - first[0], last[1] - first[1])
+    if alpha_start < 1e-6*chord or alpha_end < 1e-6*chord:
+        alpha_start = alpha_end = chord / 3
+
+    return (first,
+            (first[0] + t_start[0]*alpha_start, first[1] + t_start[1]*alpha_start),
+            (last[0] + t_end[0]*alpha_end, last[1] + t_end[1]*alpha_end),
+            last)
+
+def _max_error(samples, u, bezier):
+    """Return the largest squared distance of the samples to the bezier, and its index"""
+    error = 0.0
+    split = len(samples) // 2
+    for i in xrange(1, len(samples)-1):
+        x, y = _bezier_point(bezier, u[i])
+        ex = x - samples[i][0]
+        ey = y - samples[i][1]
+        if ex*ex + ey*ey > error:
+            error = ex*ex + ey*ey
+            split = i
+    return error, split
+
+def _newton_step(bezier, pt, t):
+    """Improve the parameter t of the point of the bezier closest to pt"""
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = bezier
+    qx, qy = _bezier_point(bezier, t)
+    s = 1 - t
+    # First and second derivatives
+    d1x = 3*(s*s*(x1-x0) + 2*s*t*(x2-x1) + t*t*(x3-x2))
+    d1y = 3*(s*s*(y1-y0) + 2*s*t*(y2-y1) + t*t*(y3-y2))
+    d2x = 6*(s*(x2 - 2*x1 + x0) + t*(x3 - 2*x2 + x1))
+    d2y = 6*(s*(y2 - 2*y1 + y0) + t*(y3 - 2*y2 + y1))
+    numerator = (qx - pt[0])*d1x + (qy - pt[1])*d1y
+    denominator = d1x*d1x + d1y*d1y + (qx - pt[0])*d2x + (qy - pt[1])*d2y
+    if denominator == 0:
+        return t
+    return min(1.0, max(0.0, t - numerator/denominator))
 
 ### Style related
 
@@ -1045,12 +1826,112 @@ def extract_width(style, width_attrib, mtx):
 
 ###### Main Class #########################################
 class SynfigExport(SynfigPrep):
+    mark_split = True
+
     def __init__(self):
         SynfigPrep.__init__(self)
+        self.OptionParser.add_option("--path-cache-size",
+                                     action="store", type="int",
+                                     dest="path_cache_size", default=0,
+                                     help="Number of converted paths to keep for reuse (0 to disable)")
+        self.OptionParser.add_option("--simplify-tolerance",
+                                     action="store", type="float",
+                                     dest="simplify_tolerance", default=0.0,
+                                     help="Simplify paths within this error, in px (0 to disable)")
+        self.OptionParser.add_option("--cull-offcanvas",
+                                     action="store", type="inkbool",
+                                     dest="cull_offcanvas", default=False,
+                                     help="Leave out objects outside of the canvas, or not displayed")
+        self.OptionParser.add_option("--cull-occluded",
+                                     action="store", type="inkbool",
+                                     dest="cull_occluded", default=False,
+                                     help="Leave out paths hidden under opaque rectangles")
+        self.OptionParser.add_option("--guids",
+                                     action="store", type="choice",
+                                     choices=SynfigDocument.guid_strategies,
+                                     dest="guids", default="random",
+                                     help="How to generate GUIDs: random, counter or hash")
+        self.OptionParser.add_option("--guid-seed",
+                                     action="store", type="string",
+                                     dest="guid_seed", default="",
+                                     help="Seed for the counter and hash GUID strategies")
+        self.OptionParser.add_option("--compact",
+                                     action="store", type="inkbool",
+                                     dest="compact", default=False,
+                                     help="Leave out params that Synfig defaults to the same value")
+        self.OptionParser.add_option("--precision",
+                                     action="store", type="int",
+                                     dest="precision", default=0,
+                                     help="Significant digits of coordinates and angles (0 for all)")
+        self.OptionParser.add_option("--compression-level",
+                                     action="store", type="int",
+                                     dest="compression_level", default=0,
+                                     help="Gzip compression level for .sifz output (0 for .sif)")
+        self.OptionParser.add_option("--output-file",
+                                     action="store", type="string",
+                                     dest="output_file", default="",
+                                     help="Write to this file instead of standard output")
+        self.OptionParser.add_option("--output-mode",
+                                     action="store", type="choice",
+                                     choices=["stream", "tree"],
+                                     dest="output_mode", default="stream",
+                                     help="Write layers as they are converted (stream), or the whole document at once (tree)")
+        self.simplified_vertices = [0, 0]
+        self.clone_groups = {}
+
+    def cache_options(self):
+        return SynfigPrep.cache_options(self) + [
+            "simplify=%r" % self.options.simplify_tolerance,
+            "cull-offcanvas=%r" % self.options.cull_offcanvas,
+            "cull-occluded=%r" % self.options.cull_occluded,
+            "guids=%s" % self.options.guids,
+            "guid-seed=%r" % self.options.guid_seed,
+            "compact=%r" % self.options.compact,
+            "precision=%d" % self.options.precision,
+            "compression-level=%d" % self.options.compression_level
+            ]
+
+    def get_path_cache(self):
+        """Return the cache of converted paths, or None if it is disabled
+
+        With --cache-dir, the cache is loaded from and saved to that directory.
+        """
+        if self.options.path_cache_size <= 0:
+            return None
+        if getattr(self, "path_cache", None) is None:
+            self.path_cache = PathCache(self.options.path_cache_size)
+            if self.get_cache() is not None:
+                self.path_cache.load(self.path_cache_file())
+        return self.path_cache
+
+    def path_cache_file(self):
+        return os.path.join(self.get_cache().directory, "paths.cache")
+
+    def save_path_cache(self):
+        """Save the path cache to the cache directory, and report its statistics"""
+        path_cache = getattr(self, "path_cache", None)
+        if path_cache is None:
+            return
+        if self.get_cache() is not None:
+            self.path_cache.save(self.path_cache_file())
+        self.report("Path cache: %d hits, %d misses (hit ratio %.2f), %d entries" % (
+                    path_cache.hits, path_cache.misses, path_cache.hit_ratio(), len(path_cache.entries)))
 
     def effect(self):
+        # An unchanged document can be copied from the cache
+        cache = self.get_cache()
+        if cache is not None:
+            key = self.cache_key("sif")
+            data = cache.get(key, "sif")
+            if data is not None:
+                output = self.open_output()
+                output.write(data)
+                self.close_output(output)
+                self.report_cache()
+                return
+
         # Prepare the document for exporting
-        SynfigPrep.effect(self)
+        self.prepare_document()
 
         svg = self.document.getroot()
         width = get_dimension(svg.get("width", 1024))
@@ -1062,17 +1943,116 @@ class SynfigExport(SynfigPrep):
         else:
             name = svg.get(addNS("docname", "sodipodi"), "Synfig Animation 1")
 
-        d = SynfigDocument(width, height, name)
+        if self.options.cull_offcanvas:
+            culled = cull_offcanvas(self.document, width, height)
+            self.report("Culling: %d nodes outside of the canvas or not displayed" % culled)
+        if self.options.cull_occluded:
+            culled = cull_occluded(self.document, width, height)
+            self.report("Culling: %d paths hidden under opaque rectangles" % culled)
+
+        d = SynfigDocument(width, height, name, defer_blines=(self.options.output_mode == "stream"),
+                           guids=self.options.guids, guid_seed=self.options.guid_seed,
+                           compact=self.options.compact,
+                           precision=self.options.precision or None)
+
+        # Groups to export as shared canvases, see convert_clone()
+        for container in svg.iterchildren(clones_tag):
+            for group in container:
+                self.clone_groups[group.get("id")] = group
+
+        # When streaming, everything that goes before the first layer
+        # is converted up front: definitions, then the canvases shared
+        # by clones
+        parsed_defs = []
+        for node in svg.iterchildren(addNS("defs", "svg")):
+            self.parse_defs(node, d)
+            parsed_defs.append(node)
+        self.export_clone_canvases(svg, d)
+
+        output = self.open_output()
+        try:
+            if self.options.compression_level > 0:
+                stream = gzip.GzipFile("", "wb", self.options.compression_level, output, mtime=0)
+            else:
+                stream = output
+
+            if self.options.output_mode == "stream":
+                # Write each top-level layer as soon as it is converted, and
+                # drop the SVG nodes it came from
+                d.write_start(stream.write)
+                for node in svg.iterchildren():
+                    if node in parsed_defs or node.tag == clones_tag:
+                        continue
+                    d.write_layers(stream.write, self.convert_node(node, d))
+                    node.clear()
+                d.write_end(stream.write)
+            else:
+                root_canvas = d.get_root_canvas()
+                for node in svg.iterchildren():
+                    if node in parsed_defs or node.tag == clones_tag:
+                        continue
+                    root_canvas.extend(self.convert_node(node, d))
+                d.get_root_tree().write(stream)
+
+            if stream is not output:
+                stream.close()
+                self.report("Output: %d bytes (%d uncompressed)" % (output.tell(), stream.size))
+            else:
+                self.report("Output: %d bytes" % output.tell())
+        except:
+            self.discard_output(output)
+            raise
 
-        layers = []
-        for node in svg.iterchildren():
-            layers += self.convert_node(node, d)
+        self.save_path_cache()
+        if self.options.simplify_tolerance > 0:
+            self.report("Simplification: %d vertices before, %d after" % tuple(self.simplified_vertices))
 
-        root_canvas = d.get_root_canvas()
-        for layer in layers:
-            root_canvas.append(layer)
+        if cache is not None:
+            output.seek(0)
+            cache.put(key, "sif", output.read())
+            self.report_cache()
+        self.close_output(output)
+
+    ### Output
+    ###  The output is written to a temporary file, so that nothing is written
+    ###  if the conversion fails midway
+
+    output_buffer_size = 1024*1024
 
-        d.get_root_tree().write(sys.stdout)
+    def open_output(self):
+        """Open a temporary file for the output, see close_output()
+
+        With --output-file, the file is created next to the output file.
+        """
+        if not self.options.output_file:
+            return tempfile.TemporaryFile()
+        fd, self.output_temp_path = tempfile.mkstemp(
+            ".tmp", dir=os.path.dirname(self.options.output_file) or ".")
+        return os.fdopen(fd, "w+b", self.output_buffer_size)
+
+    def close_output(self, output):
+        """Move the output to the output file (replacing it), or to standard output"""
+        if not self.options.output_file:
+            if sys.platform == "win32":
+                # Keep the output intact (it may be compressed): no newline translation
+                import msvcrt
+                msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+            output.seek(0)
+            shutil.copyfileobj(output, sys.stdout, self.output_buffer_size)
+            output.close()
+            return
+
+        output.close()
+        # Temporary files are private, but the output is created like any other file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.output_temp_path, 0666 & ~umask)
+        replace_file(self.output_temp_path, self.options.output_file)
+
+    def discard_output(self, output):
+        output.close()
+        if self.options.output_file:
+            os.remove(self.output_temp_path)
 
     def convert_node(self, node, d):
         """Convert an SVG node to a list of Synfig layers"""
@@ -1084,6 +2064,11 @@ class SynfigExport(SynfigPrep):
             return []
         elif node.tag == addNS("metadata", "svg"):
             return []
+        elif node.tag == clones_tag:
+            # Shared clone canvases are exported when first used
+            return []
+        elif node.tag == addNS("use", "svg") and node.get(canvas_attrib):
+            layers = self.convert_clone(node, d)
         elif node.tag not in [
             addNS("g", "svg"),
             addNS("a", "svg"),
@@ -1091,8 +2076,9 @@ class SynfigExport(SynfigPrep):
             addNS("path", "svg")]:
             # An unsupported element
             return []
+        else:
+            layers = []
 
-        layers = []
         if node.tag == addNS("g", "svg"):
             for subnode in node:
                 layers += self.convert_node(subnode, d)
@@ -1113,12 +2099,60 @@ class SynfigExport(SynfigPrep):
             filter_id = style["filter"][5:].split(")")[0]
             layers = d.op_filter(layers, filter_id)
 
+        # Split paths have already applied their opacity to each half,
+        # and shared clone canvases include the opacity of their clones
         opacity = extract_opacity(style, "opacity")
-        if opacity != 1.0:
+        if opacity != 1.0 and node.get(split_attrib) != "fill-stroke" and node.get(canvas_attrib) is None:
             layers = d.op_fade(layers, opacity)
 
         return layers
 
+    def export_canvas(self, canvas_id, d):
+        """Export the shared canvas of a clone (see synfig_prepare.share_clones), if not done yet"""
+        if d.has_canvas(canvas_id):
+            return
+        if canvas_id not in self.clone_groups:
+            raise MalformedSVGError, "Shared canvas %s not found" % canvas_id
+        layers = []
+        for subnode in self.clone_groups[canvas_id]:
+            layers += self.convert_node(subnode, d)
+        d.add_canvas(canvas_id, layers)
+
+    def export_clone_canvases(self, node, d):
+        """Export the shared canvases of all clones under a node, in the order convert_node meets them"""
+        containers = [addNS("svg", "svg"), addNS("g", "svg"), addNS("a", "svg"), addNS("switch", "svg")]
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.tag == addNS("use", "svg") and node.get(canvas_attrib):
+                self.export_canvas(node.get(canvas_attrib), d)
+            elif node.tag in containers:
+                stack.extend(reversed(node.getchildren()))
+
+    def convert_clone(self, node, d):
+        """Convert a clone with a shared canvas (see synfig_prepare.share_clones) to a PasteCanvas layer"""
+        canvas_id = node.get(canvas_attrib)
+        self.export_canvas(canvas_id, d)
+
+        # The clone offset is applied after the clone's own transform
+        x = get_dimension(node.get("x", "0"))
+        y = get_dimension(node.get("y", "0"))
+        mtx = simpletransform.parseTransform(node.get("transform"))
+        mtx = simpletransform.composeTransform(mtx, [[1.0, 0.0, x], [0.0, 1.0, y]])
+
+        node_id = node.get("id", str(id(node)))
+        if mtx[0][0:2] == [1.0, 0.0] and mtx[1][0:2] == [0.0, 1.0]:
+            # A translation is the origin of the PasteCanvas
+            origin = d.coor_svg2sif([mtx[0][2], mtx[1][2]])
+            zero = d.coor_svg2sif([0.0, 0.0])
+            return [d.create_layer("PasteCanvas", node_id, params={
+                        "canvas": canvas_id,
+                        "origin": [origin[0] - zero[0], origin[1] - zero[1]]
+                        })]
+
+        layer = d.create_layer("PasteCanvas", node_id, params={"canvas": canvas_id})
+        return d.op_transform([layer], mtx)
+
     def parse_defs(self, node, d):
         for child in node.iterchildren():
             if child.tag == addNS("linearGradient", "svg"):
@@ -1256,16 +2290,107 @@ class SynfigExport(SynfigPrep):
 
     def convert_path(self, node, d):
         """Convert an SVG path node to a list of Synfig layers"""
-        layers = []
-
         node_id = node.get("id", str(id(node)))
         style = extract_style(node)
         mtx = simpletransform.parseTransform(node.get("transform"))
+        nodetypes = node.get(addNS("nodetypes", "sodipodi"))
+
+        if node.get(split_attrib) != "fill-stroke":
+            blines = self.path_blines(node.get("d", ""), nodetypes, mtx, d)
+            return self.convert_blines(blines, style, node_id, mtx, d)
+
+        # The path is exported as a separate fill and stroke (see
+        # synfig_prepare.mark_fill_and_stroke), built from the same parsed data
+        path_d = node.get("d", "")
+        path = []
+        opacity = extract_opacity(style, "opacity")
+
+        fill_style = style.copy()
+        fill_style["stroke"] = "none"
+        fill_blines = self.path_blines(path_d, nodetypes, mtx, d, path, fuse=True)
+        fill_layers = self.convert_blines(fill_blines, fill_style, node_id+"-fill", mtx, d)
+
+        stroke_style = style.copy()
+        stroke_style["fill"] = "none"
+        stroke_blines = self.path_blines(path_d, nodetypes, mtx, d, path)
+        stroke_layers = self.convert_blines(stroke_blines, stroke_style, node_id+"-stroke", mtx, d)
+
+        # Each half gets its own opacity, as if it were a separate path
+        if opacity != 1.0:
+            fill_layers = d.op_fade(fill_layers, opacity)
+            stroke_layers = d.op_fade(stroke_layers, opacity)
+
+        return fill_layers + stroke_layers
+
+    # Paths with more data than this are never cached
+    path_cache_max_data = 64*1024
+
+    def path_blines(self, path_d, nodetypes, mtx, d, path=None, fuse=False):
+        """Return the BLines (in Synfig units) of path data, reusing earlier conversions when possible
+
+        mtx is the transformation of the path node. If path is a list, it holds
+        the parsed path data: it is filled on first use, so that the data is
+        parsed at most once. With fuse, the subpaths are fused into a single
+        outline (see synfig_prepare.fuse_path).
+        """
+        cache = self.get_path_cache()
+        if len(path_d) > self.path_cache_max_data:
+            # Large paths are streamed one subpath at a time instead
+            cache = None
+        if cache is None:
+            # Transform the path and convert it to Synfig units in a single pass
+            return self.convert_path_data(path_d, nodetypes, d.svg2sif_matrix(mtx), path, fuse,
+                                          self.options.simplify_tolerance / sif.kux)
+
+        # Cached paths are in SVG units, so that they can be shared between
+        # documents of any size, and only then converted to Synfig units
+        key = cache.key(path_d, nodetypes, mtx, fuse, self.options.simplify_tolerance)
+        blines = cache.get(key)
+        if blines is None:
+            blines = list(self.convert_path_data(path_d, nodetypes, mtx, path, fuse,
+                                                 self.options.simplify_tolerance))
+            cache.put(key, blines)
+        svg2sif = d.svg2sif_matrix()
+        for bline in blines:
+            bline.transform(svg2sif)
+        return blines
+
+    def convert_path_data(self, path_d, nodetypes, mtx, path, fuse, tolerance):
+        """Convert path data to BLines transformed by mtx, simplified to within tolerance
+
+        See path_blines() for path and fuse.
+        """
+        if path is None:
+            segments = iter_path(path_d)
+        else:
+            if not path:
+                path.extend(iter_path(path_d))
+            segments = path
+        if fuse:
+            segments = fuse_path(segments)
+
+        blines = iter_blines(segments, nodetypes, mtx)
+        if tolerance > 0:
+            blines = self.simplify_blines(blines, tolerance)
+        return blines
+
+    def simplify_blines(self, blines, tolerance):
+        """Simplify BLines to within tolerance (in their own units), counting vertices"""
+        for bline in blines:
+            simplified = simplify_bline(bline, tolerance)
+            self.simplified_vertices[0] += len(bline)
+            self.simplified_vertices[1] += len(simplified)
+            yield simplified
+
+    def convert_blines(self, blines, style, node_id, mtx, d):
+        """Convert BLines (in Synfig units) to region and outline layers with the given style
+
+        blines may be any iterable; each BLine is only needed until its layers are built.
+        """
+        layers = []
 
-        blines = path_to_bline_list(node.get("d"), node.get(addNS("nodetypes", "sodipodi")), mtx)
         for bline in blines:
-            d.bline_coor_svg2sif(bline)
-            bline_guid = d.new_guid()
+            bline_guid = d.new_guid("bline", node_id)
 
             if style.setdefault("fill", "#000000")  != "none":
                 if style["fill"].startswith("url"):
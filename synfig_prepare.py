@@ -20,12 +20,28 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
 """
 
-import os, tempfile
+import os, re, sys, math, tempfile, threading, atexit
+import hashlib, json
+import Queue
+from copy import deepcopy
+from collections import deque
 
 import inkex
 from inkex import NSS, addNS, etree, errormsg
 import simplepath, simplestyle, simpletransform
 
+# Namespace of the attributes that svg2sif adds to prepared documents
+svg2sif_ns = "http://github.com/nikitakit/svg2sif"
+split_attrib = "{%s}split" % svg2sif_ns
+clones_tag = "{%s}clones" % svg2sif_ns      # Container of the shared clone canvases
+canvas_attrib = "{%s}canvas" % svg2sif_ns   # The shared canvas used by a clone
+
+# Serialize them with a readable prefix (needs lxml 2.3)
+try:
+    etree.register_namespace("svg2sif", svg2sif_ns)
+except AttributeError:
+    pass
+
 ###### Utility Classes ####################################
 
 class MalformedSVGError(Exception):
@@ -46,14 +62,229 @@ try:
 except:
     bsubprocess = False
 
+class InkscapeWorker(object):
+    """A long-lived Inkscape process running in shell mode
+
+    Inkscape reads one command line at a time from its standard input and
+    prints a prompt when it is ready for the next one, so a single process can
+    handle any number of documents without paying its startup cost again.
+    """
+    prompt = ">"
+
+    def __init__(self, executable="inkscape"):
+        self.executable = executable
+        self.process = None
+
+    def start(self):
+        """Start the Inkscape process and wait for the first prompt"""
+        devnull = open(os.devnull, "w")
+        self.process = Popen([self.executable, "--shell"], stdin=PIPE, stdout=PIPE, stderr=devnull)
+        devnull.close()
+        self._wait_for_prompt()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _wait_for_prompt(self):
+        """Read the output of the process until it prints its prompt"""
+        fd = self.process.stdout.fileno()
+        last = "\n"
+        while True:
+            c = os.read(fd, 1)
+            if c == "":
+                raise IOError("Inkscape worker exited unexpectedly")
+            if c == self.prompt and last == "\n":
+                return
+            last = c
+
+    def run(self, args):
+        """Run a single command line, and wait for it to finish"""
+        if not self.is_alive():
+            self.start()
+        try:
+            self._send(args)
+        except (IOError, OSError):
+            # The process is in an unknown state: replace it with a fresh one
+            self.kill()
+            self.start()
+            self._send(args)
+
+    def _send(self, args):
+        self.process.stdin.write(args.replace("\n", " ") + "\n")
+        self.process.stdin.flush()
+        self._wait_for_prompt()
+
+    def kill(self):
+        """Stop the process without waiting for it to finish its command"""
+        if self.is_alive():
+            self.process.kill()
+        if self.process is not None:
+            self.process.wait()
+            self.process = None
+
+    def close(self):
+        """Ask the process to quit"""
+        if not self.is_alive():
+            return
+        try:
+            self.process.stdin.write("quit\n")
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+class InkscapeWorkerPool(object):
+    """A pool of Inkscape workers that action groups can send commands to
+
+    Workers are started on demand, up to the size of the pool, so that
+    documents converted from several threads at once (see svg2sif_batch.py)
+    each get their own Inkscape process. The executable can be replaced with
+    any program that speaks Inkscape's shell protocol, e.g. a stand-in for
+    testing on machines without Inkscape.
+    """
+    def __init__(self, size=1, executable="inkscape"):
+        self.size = max(1, size)
+        self.executable = executable
+        self.workers = []
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        """Take an idle worker, starting a new one if the pool is not full"""
+        self.lock.acquire()
+        try:
+            if self.idle.empty() and len(self.workers) < self.size:
+                worker = InkscapeWorker(self.executable)
+                self.workers.append(worker)
+                return worker
+        finally:
+            self.lock.release()
+        return self.idle.get()
+
+    def run(self, args):
+        """Run a command line on the first available worker"""
+        worker = self._acquire()
+        try:
+            worker.run(args)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        """Shut down all workers"""
+        self.lock.acquire()
+        try:
+            for worker in self.workers:
+                worker.close()
+            self.workers = []
+            self.idle = Queue.Queue()
+        finally:
+            self.lock.release()
+
+_worker_pools = {}
+_worker_pools_lock = threading.Lock()
+
+def get_worker_pool(size=1, executable="inkscape"):
+    """Return a shared worker pool, so that it can be reused across documents
+
+    Each conversion calls Inkscape at most once, so the pool only saves time
+    when one process converts many documents, see svg2sif_batch.py.
+    """
+    key = (size, executable)
+    _worker_pools_lock.acquire()
+    try:
+        if key not in _worker_pools:
+            _worker_pools[key] = InkscapeWorkerPool(size, executable)
+        return _worker_pools[key]
+    finally:
+        _worker_pools_lock.release()
+
+def _close_worker_pools():
+    for pool in _worker_pools.values():
+        pool.close()
+
+atexit.register(_close_worker_pools)
+
+_inkscape_versions = {}
+
+def inkscape_version(executable="inkscape"):
+    """Return the version of Inkscape as a tuple of ints, or None if it is not known
+
+    The result is cached for each executable.
+    """
+    if executable in _inkscape_versions:
+        return _inkscape_versions[executable]
+
+    version = None
+    if bsubprocess:
+        try:
+            devnull = open(os.devnull, "w")
+            p = Popen([executable, "--version"], stdin=devnull, stdout=PIPE, stderr=devnull)
+            devnull.close()
+            out = p.communicate()[0]
+            m = re.search(r"Inkscape\s+([0-9]+)\.([0-9]+)", out)
+            if m:
+                version = (int(m.group(1)), int(m.group(2)))
+        except OSError:
+            pass
+    _inkscape_versions[executable] = version
+    return version
+
+def shell_verbs_supported(executable="inkscape"):
+    """Return whether Inkscape runs --verb command lines in shell mode
+
+    Inkscape 0.x shell mode takes the same arguments as its command line;
+    Inkscape 1.x shell mode only takes actions. Unknown versions (such as
+    stand-ins) are assumed to speak the 0.x protocol.
+    """
+    version = inkscape_version(executable)
+    return version is None or version < (1, 0)
+
+def pipe_supported(executable="inkscape"):
+    """Return whether Inkscape reads and writes documents through pipes (1.0 and later)
+
+    Unknown versions are tried, and run_document() checks the result.
+    """
+    version = inkscape_version(executable)
+    return version is None or version >= (1, 0)
+
+class CountingWriter(object):
+    """A file-like object that counts the bytes written to another one"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.count += len(data)
+
+# RAM-backed directory for temporary files, used when it is available
+shm_dir = "/dev/shm"
+
 class InkscapeActionGroup(object):
-    """A class for calling Inkscape to perform operations on a document"""
-    def __init__(self, svg_document=None):
+    """A class for calling Inkscape to perform operations on a document
+
+    The document is handed to Inkscape in one of the following ways:
+    "pipe" -- stream it through Inkscape's standard input and output
+    "shm" -- use a temporary file in RAM-backed storage, if available
+    "file" -- use a temporary file in the default temporary directory
+    """
+    chunk_size = 65536
+
+    def __init__(self, svg_document=None, pool=None, executable="inkscape", hand_off="shm"):
         self.command = ""
         self.init_args = ""
         self.has_selection = False
         self.has_action = False
         self.svg_document = svg_document
+        self.pool = pool
+        self.executable = executable
+        self.hand_off = hand_off
+        self.result_check = None
+
+        # What run_document() actually did, see svg2sif_benchmark.py
+        self.hand_off_used = None
+        self.bytes_written = 0
+        self.bytes_read = 0
 
     def set_svg_document(self, svg_document):
         """Set the SVG document that Inkscape will operate on"""
@@ -67,6 +298,19 @@ class InkscapeActionGroup(object):
         """
         self.init_args = cmd
 
+    def set_result_check(self, xpath):
+        """Set an XPath expression that must not match anything once the actions have run
+
+        A piped result that fails the check is discarded, see run_document().
+        """
+        self.result_check = xpath
+
+    def check_result(self, document):
+        """Return whether the actions were applied to document"""
+        if self.result_check is None:
+            return True
+        return not document.xpath(self.result_check, namespaces=NSS)
+
     def clear(self):
         """Clear all actions"""
         self.command = ""
@@ -128,41 +372,118 @@ class InkscapeActionGroup(object):
         if not self.has_action:
             return
 
+        if self.pool is not None and bsubprocess:
+            # Workers stay alive between documents, so close the file instead of quitting
+            cmd = self.init_args + " " + self.command + "--verb=FileSave --verb=FileClose"
+            self.pool.run('"%s" %s' % (filename, cmd))
+            return
+
         cmd = self.init_args + " " + self.command + "--verb=FileSave --verb=FileQuit"
 
         if bsubprocess:
-            p = Popen('inkscape "%s" %s' % (filename, cmd), shell=True, stdout=PIPE, stderr=PIPE)
+            p = Popen('%s "%s" %s' % (self.executable, filename, cmd), shell=True, stdout=PIPE, stderr=PIPE)
             rc = p.wait()
             f = p.stdout
             err = p.stderr
         else:
-            _, f, err = os.popen3( "inkscape %s %s" % ( filename, cmd ) )
+            _, f, err = os.popen3( "%s %s %s" % ( self.executable, filename, cmd ) )
 
         f.close()
         err.close()
 
+    def run_pipe(self):
+        """Run the actions by streaming the document through Inkscape
+
+        The document is written to the standard input of Inkscape while the
+        result is parsed incrementally from its standard output, so it never
+        touches the disk. This requires an Inkscape that supports --pipe.
+
+        Returns the new document, or None if Inkscape produced no output.
+        """
+        cmd = "%s --pipe --export-type=svg --export-filename=- %s %s" % (
+            self.executable, self.init_args, self.command)
+
+        devnull = open(os.devnull, "w")
+        p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=devnull)
+        devnull.close()
+
+        # Feed the document from another thread, so that
+        # neither side can block on a full pipe
+        stdin = CountingWriter(p.stdin)
+        def write_document():
+            try:
+                self.svg_document.write(stdin)
+                p.stdin.close()
+            except IOError:
+                pass
+        writer = threading.Thread(target=write_document)
+        writer.daemon = True
+        writer.start()
+
+        parser = etree.XMLParser()
+        try:
+            while True:
+                chunk = p.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.bytes_read += len(chunk)
+                parser.feed(chunk)
+            document = parser.close().getroottree()
+        except etree.XMLSyntaxError:
+            # No output, or malformed output: stop Inkscape, and let
+            # run_document() fall back to a temporary file
+            document = None
+            if p.poll() is None:
+                p.kill()
+
+        writer.join()
+        rc = p.wait()
+        self.bytes_written += stdin.count
+
+        if rc != 0:
+            return None
+        return document
+
     def run_document(self):
         """Run the actions on the svg xml tree"""
         if not self.has_action:
             return self.svg_document
 
-        # First save the document
-        svgfile = tempfile.mktemp(".svg")
-        self.svg_document.write(svgfile)
-
-        # Run the action on the document
-        self.run_file(svgfile)
-
-        # Open the resulting file
-        stream = open(svgfile, 'r')
-        new_svg_doc = etree.parse(stream)
-        stream.close()
-
-        # Clean up.
-        try:
-            os.remove(svgfile)
-        except Exception:
-            pass
+        new_svg_doc = None
+        if self.hand_off == "pipe" and self.pool is None and bsubprocess \
+                and pipe_supported(self.executable):
+            self.hand_off_used = "pipe"
+            new_svg_doc = self.run_pipe()
+
+            # An Inkscape that ignores some of the actions can still succeed,
+            # returning the document unchanged
+            if new_svg_doc is not None and not self.check_result(new_svg_doc):
+                new_svg_doc = None
+
+        if new_svg_doc is None:
+            # First save the document, preferably to memory-backed storage
+            temp_dir = None
+            if self.hand_off != "file" and os.path.isdir(shm_dir) and os.access(shm_dir, os.W_OK):
+                temp_dir = shm_dir
+            fd, svgfile = tempfile.mkstemp(".svg", dir=temp_dir)
+            stream = os.fdopen(fd, "w")
+            self.svg_document.write(stream)
+            stream.close()
+            self.bytes_written += os.path.getsize(svgfile)
+            self.hand_off_used = temp_dir or tempfile.gettempdir()
+
+            # Run the action on the document
+            self.run_file(svgfile)
+            self.bytes_read += os.path.getsize(svgfile)
+
+            # Open the resulting file (libxml2 reads it in chunks)
+            new_svg_doc = etree.parse(svgfile)
+
+            # Clean up.
+            try:
+                os.remove(svgfile)
+            except Exception:
+                pass
 
         # Set the current SVG document
         self.svg_document = new_svg_doc
@@ -172,11 +493,25 @@ class InkscapeActionGroup(object):
 
 class SynfigExportActionGroup(InkscapeActionGroup):
     """An action group with stock commands designed for Synfig exporting"""
-    def __init__(self, svg_document=None):
-        InkscapeActionGroup.__init__(self, svg_document)
+    non_paths = [
+        "svg:rect",
+        "svg:circle",
+        "svg:ellipse",
+        "svg:line",
+        "svg:polyline",
+        "svg:polygon",
+        "svg:text"
+        ]
+
+    def __init__(self, svg_document=None, pool=None, executable="inkscape", hand_off="shm", unlink_clones=True):
+        InkscapeActionGroup.__init__(self, svg_document, pool, executable, hand_off)
         self.set_init_args("--verb=UnlockAllInAllLayers")
         self.objects_to_paths()
-        self.unlink_clones()
+        converted = ["//svg:flowRoot"] + ["//" + np for np in self.non_paths]
+        if unlink_clones:
+            self.unlink_clones()
+            converted.append("//svg:use")
+        self.set_result_check(" | ".join(converted))
 
     def objects_to_paths(self):
         """Convert unsupported objects to paths"""
@@ -186,18 +521,9 @@ class SynfigExportActionGroup(InkscapeActionGroup):
         self.verb("ObjectToPath")
         self.deselect()
 
-        non_paths = [
-            "svg:rect",
-            "svg:circle",
-            "svg:ellipse",
-            "svg:line",
-            "svg:polyline",
-            "svg:polygon",
-            "svg:text"
-            ]
-
         # Build an xpath command to select these nodes
-        xpath_cmd = " | ".join(["//" + np for np in non_paths])
+        # Note: documents that went through shapes_to_paths() only have text left
+        xpath_cmd = " | ".join(["//" + np for np in self.non_paths])
 
         # Select all of these elements
         # Note: already selected elements are not deselected
@@ -213,60 +539,417 @@ class SynfigExportActionGroup(InkscapeActionGroup):
         self.verb("EditUnlinkClone")
         self.deselect()
 
-###### Utility Functions ##################################
+class DocumentSummary(object):
+    """A summary of what a document needs from the prepare stage
 
-### Path related
+    The document is scanned in a single pass, counting:
+    shapes -- basic shapes that need to be converted to paths
+    texts -- text and flowed text that need Inkscape to be converted to paths
+    clones -- clones that need to be unlinked
+    inherited -- nodes with styles or transforms that need to be propagated
+    multi_subpaths -- paths with more than one subpath
+    """
+    containers = [
+        addNS("svg", "svg"),
+        addNS("g", "svg"),
+        addNS("a", "svg"),
+        addNS("switch", "svg")
+        ]
+    shape_tags = [addNS(tag, "svg") for tag in ["rect", "circle", "ellipse", "line", "polyline", "polygon"]]
+    text_tags = [addNS("text", "svg"), addNS("flowRoot", "svg")]
+
+    def __init__(self, document):
+        self.shapes = 0
+        self.texts = 0
+        self.clones = 0
+        self.inherited = 0
+        self.multi_subpaths = 0
+        self.scan(document)
+
+    def scan(self, document):
+        path_tag = addNS("path", "svg")
+        use_tag = addNS("use", "svg")
+        for node in document.getroot().iter():
+            tag = node.tag
+            if not isinstance(tag, basestring):
+                continue
+            attrib = node.attrib
+
+            if tag == path_tag:
+                if attrib.get("d", "").lower().count("m") > 1:
+                    self.multi_subpaths += 1
+            elif tag in self.shape_tags:
+                self.shapes += 1
+            elif tag in self.text_tags:
+                self.texts += 1
+            elif tag == use_tag:
+                self.clones += 1
+
+            # Presentation attributes are always moved into the style,
+            # and containers pass their style and transform to their children
+            if "fill" in attrib or "stroke" in attrib:
+                self.inherited += 1
+            elif tag in self.containers:
+                if "transform" in attrib or "viewBox" in attrib:
+                    self.inherited += 1
+                elif "style" in attrib and simplestyle.parseStyle(attrib["style"]).keys() not in [[], ["filter"]]:
+                    self.inherited += 1
+
+    def needs_inkscape(self):
+        return self.texts > 0
+
+    def needs_propagation(self):
+        # Unlinked clones and converted text bring their own transforms
+        return self.inherited > 0 or self.clones > 0 or self.texts > 0
+
+    def needs_fusing(self):
+        # Converted text usually has multiple subpaths
+        return self.multi_subpaths > 0 or self.texts > 0
 
-def fuse_subpaths(path_node):
-    """Fuse subpaths of a path. Should only be used on unstroked paths"""
-    path_d = path_node.get("d", None)
-    path = simplepath.parsePath(path_d)
+    def __str__(self):
+        return ("%d shapes, %d texts, %d clones, %d nodes with inherited attributes, "
+                "%d paths with multiple subpaths" % (self.shapes, self.texts, self.clones,
+                                                     self.inherited, self.multi_subpaths))
 
-    if len(path) == 0:
-        return
+def replace_file(source, target):
+    """Rename source to target, replacing target if it exists
 
-    i = 0
-    initial_point = [ path[i][1][-2], path[i][1][-1] ]
-    return_stack = []
-    while i < len(path):
-        # Remove any terminators: they are redundant
-        if path[i][0] == "Z":
-            path.remove(["Z", []])
-            continue
+    On Windows, os.rename() fails when the target exists, so the target is
+    removed first (the replacement is then not atomic).
+    """
+    try:
+        os.rename(source, target)
+    except OSError:
+        if sys.platform != "win32" or not os.path.exists(target):
+            raise
+        os.remove(target)
+        os.rename(source, target)
+
+class DocumentCache(object):
+    """A content-addressed cache of converted documents, stored on disk
+
+    Entries are keyed on a hash of the input document and of the options
+    used to convert it. When the cache grows over its size limit, the least
+    recently used entries are removed. Hit statistics are kept in the cache
+    directory, so that they cover every run that used it.
+    """
+    version = "1" # Change to invalidate entries written by older versions
+
+    def __init__(self, directory, max_size=64*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.stats_file = os.path.join(directory, "stats.json")
+
+    def key(self, data, options=[]):
+        """Return the key of a document, given its contents and conversion options"""
+        h = hashlib.sha1()
+        h.update(data)
+        h.update(repr([self.version] + list(options)))
+        return h.hexdigest()
+
+    def _entry_path(self, key, kind):
+        return os.path.join(self.directory, "%s.%s" % (key, kind))
+
+    def get(self, key, kind):
+        """Return the cached data of the given kind ("svg", "sif"), or None"""
+        path = self._entry_path(key, kind)
+        try:
+            stream = open(path, "rb")
+        except IOError:
+            self._count("misses")
+            return None
+        data = stream.read()
+        stream.close()
 
-        # Skip all elements that do not begin a new path
-        if i == 0 or path[i][0] != "M":
-            i += 1
-            continue
+        # Mark the entry as recently used
+        os.utime(path, None)
+        self._count("hits")
+        return data
+
+    def put(self, key, kind, data):
+        """Store data in the cache, evicting old entries if needed"""
+        fd, temp_path = tempfile.mkstemp(".tmp", dir=self.directory)
+        stream = os.fdopen(fd, "wb")
+        stream.write(data)
+        stream.close()
+        replace_file(temp_path, self._entry_path(key, kind))
+        self.evict()
+
+    def _entries(self):
+        """Return a list of [mtime, size, path] of all cache entries"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".svg") or name.endswith(".sif"):
+                st = os.stat(path)
+                entries.append([st.st_mtime, st.st_size, path])
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its size limit"""
+        entries = self._entries()
+        size = sum([e[1] for e in entries])
+        entries.sort()
+        evicted = 0
+        while size > self.max_size and entries:
+            _, entry_size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            evicted += 1
+        if evicted:
+            self._count("evictions", evicted)
+
+    def _load_stats(self):
+        try:
+            stream = open(self.stats_file, "r")
+            stats = json.load(stream)
+            stream.close()
+        except (IOError, ValueError):
+            stats = {}
+        for counter in ["hits", "misses", "evictions"]:
+            stats.setdefault(counter, 0)
+        return stats
+
+    def _count(self, counter, amount=1):
+        stats = self._load_stats()
+        stats[counter] += amount
+        try:
+            stream = open(self.stats_file, "w")
+            json.dump(stats, stream)
+            stream.close()
+        except IOError:
+            pass
+
+    def stats(self):
+        """Return the cache statistics
+
+        Returns a dictionary with the number of hits, misses and evictions,
+        the hit ratio, and the number and total size of the entries.
+        """
+        stats = self._load_stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = float(stats["hits"]) / lookups if lookups else 0.0
+        entries = self._entries()
+        stats["entries"] = len(entries)
+        stats["size"] = sum([e[1] for e in entries])
+        return stats
+
+###### Utility Functions ##################################
+
+### Path related
+
+path_command = re.compile(r"[MmZzLlHhVvCcSsQqTtAa]")
+path_number = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
 
-        # This element begins a new path - it should be a moveto
-        assert(path[i][0] == 'M')
+# Number of parameters of each path command
+path_params = {"M":2, "L":2, "H":1, "V":1, "C":6, "S":4, "Q":4, "T":2, "A":7, "Z":0}
 
-        # Swap it for a lineto
-        path[i][0] = 'L'
+# Path data is scanned for numbers in windows of about this many characters
+path_window = 65536
+path_separator = re.compile(r"[\s,]")
 
-        # If the old subpath has not been closed yet, close it
-        if path[i-1][1][-2] != initial_point[0] or path[i-1][1][-2] != initial_point[1]:
-            path.insert(i, ['L', initial_point])
-            i += 1
+def _path_params(path_d, start, end, n, cmd):
+    """Return the parameters of a path command, as an iterable of groups of n
 
-        # Set the initial point of this subpath
-        initial_point = [ path[i-1][1][-2], path[i-1][1][-1] ]
+    The numbers are read from path_d[start:end] in place. Long runs of
+    implicit parameters are read one window at a time, so that they are
+    never copied or held as a whole.
+    """
+    if end - start <= path_window:
+        # Most commands have a few parameters: read them all at once
+        nums = map(float, path_number.findall(path_d, start, end))
+        if len(nums) == 0 or len(nums) % n != 0:
+            raise MalformedSVGError, "Bad path data: wrong number of parameters for %s" % cmd
+        if len(nums) == n:
+            return (nums,)
+        return [nums[k:k+n] for k in xrange(0, len(nums), n)]
+    return _path_windows(path_d, start, end, n, cmd)
+
+def _path_windows(path_d, start, end, n, cmd):
+    """Yield the parameters of a long path command in groups of n, see _path_params()"""
+    nums = []
+    count = 0
+    pos = start
+    while pos < end:
+        # Windows end on a separator, so that no number is cut in two
+        m = path_separator.search(path_d, min(pos + path_window, end), end)
+        window_end = m.end() if m is not None else end
+        nums.extend(map(float, path_number.findall(path_d, pos, window_end)))
+        pos = window_end
+
+        k = 0
+        while k + n <= len(nums):
+            yield nums[k:k+n]
+            k += n
+        count += k
+        del nums[:k]
+
+    if nums or count == 0:
+        raise MalformedSVGError, "Bad path data: wrong number of parameters for %s" % cmd
+
+def iter_path(path_d):
+    """Parse path data lazily, yielding segments in the format of simplepath.parsePath
+
+    path_d may be a string or a buffer. All segments are absolute, H and V
+    are turned into L, S into C, and T into Q, so the only commands are
+    M, L, C, Q, A and Z.
+    """
+    px = py = 0.0       # Current point
+    sx = sy = 0.0       # Start of the current subpath
+    ctrl = None         # Last control point, for reflection by S and T
+    last = None         # Last command that left a control point ("C" or "Q")
+
+    m = path_command.search(path_d)
+    if m is not None and path_d[:m.start()].strip():
+        raise MalformedSVGError, "Bad path data: path doesn't start with a command"
+
+    while m is not None:
+        cmd = m.group()
+        ucmd = cmd.upper()
+        relative = cmd != ucmd
+
+        # The parameters run up to the next command
+        start = m.end()
+        m = path_command.search(path_d, start)
+        end = m.start() if m is not None else len(path_d)
+
+        if ucmd == "Z":
+            yield ["Z", []]
+            px, py = sx, sy
+            last = None
+            continue
+
+        n = path_params[ucmd]
+        for i, p in enumerate(_path_params(path_d, start, end, n, cmd)):
+            if ucmd == "A":
+                p[3] = int(p[3])
+                p[4] = int(p[4])
+                if relative:
+                    p[5] += px
+                    p[6] += py
+            elif ucmd == "H":
+                p = [p[0] + px if relative else p[0], py]
+            elif ucmd == "V":
+                p = [px, p[0] + py if relative else p[0]]
+            elif relative:
+                for j in xrange(0, n, 2):
+                    p[j] += px
+                    p[j+1] += py
+
+            if ucmd == "M":
+                if i == 0:
+                    sx, sy = p
+                    segment = ["M", p]
+                else:
+                    # Extra coordinate pairs of a moveto are linetos
+                    segment = ["L", p]
+            elif ucmd == "S":
+                if last == "C":
+                    segment = ["C", [2*px - ctrl[0], 2*py - ctrl[1]] + p]
+                else:
+                    segment = ["C", [px, py] + p]
+            elif ucmd == "T":
+                if last == "Q":
+                    segment = ["Q", [2*px - ctrl[0], 2*py - ctrl[1]] + p]
+                else:
+                    segment = ["Q", [px, py] + p]
+            elif ucmd == "H" or ucmd == "V":
+                segment = ["L", p]
+            else:
+                segment = [ucmd, p]
+
+            params = segment[1]
+            if segment[0] == "C" or segment[0] == "Q":
+                last = segment[0]
+                ctrl = params[-4:-2]
+            else:
+                last = None
+            px = params[-2]
+            py = params[-1]
+
+            yield segment
+
+def fuse_path(path):
+    """Fuse the subpaths of a parsed path into a single subpath
+
+    Each subpath is closed, then joined to the next one with a line from its
+    starting point. Once the last subpath is done, the joining lines are
+    walked back in reverse order, so that they cancel out when filled.
+    The path is built in a single pass.
+    """
+    fused = []
+    start = None    # Starting point of the current subpath
+    last = None     # Current point
+    return_stack = []
+    for cmd, params in path:
+        if cmd == "Z":
+            # Close the subpath explicitly, the terminator itself is redundant
+            if last != start:
+                fused.append(["L", start[:]])
+            last = start
+        elif cmd == "M":
+            if start is None:
+                fused.append(["M", params[:]])
+            else:
+                # If the old subpath has not been closed yet, close it
+                if last != start:
+                    fused.append(["L", start[:]])
+                return_stack.append(start)
+                # Swap the moveto for a lineto
+                fused.append(["L", params[:]])
+            start = params[-2:]
+            last = start
+        else:
+            fused.append([cmd, params])
+            last = params[-2:]
 
-        # Append this point to the return stack
-        return_stack.append(initial_point)
-    #end while
+    if start is not None and last != start:
+        fused.append(["L", start[:]])
 
     # Now pop the entire return stack
     while return_stack != []:
-        el = ['L', return_stack.pop()]
-        path.insert(i, el)
-        i += 1
+        fused.append(["L", return_stack.pop()[:]])
+
+    return fused
+
+def fuse_subpaths(path_node):
+    """Fuse subpaths of a path. Should only be used on unstroked paths"""
+    path_d = path_node.get("d", None)
+    if not path_d:
+        return
 
+    path = fuse_path(iter_path(path_d))
+    if len(path) == 0:
+        return
 
     path_d = simplepath.formatPath(path)
     path_node.set("d", path_d)
 
+def mark_fill_and_stroke(path_node):
+    """Mark a path to be exported as a separate fill and stroke
+
+    Unlike split_fill_and_stroke(), this leaves the path in place: the
+    exporter parses its data once and builds both the fill and the stroke
+    from it, fusing the subpaths of the fill.
+
+    Returns a the list [fill, stroke], where each is the path node if it has
+    a fill or stroke, or None.
+    """
+    style = simplestyle.parseStyle(path_node.get("style", ""))
+
+    has_fill = style.get("fill") != "none"
+    has_stroke = style.get("stroke", "none") != "none"
+
+    if has_fill and has_stroke:
+        path_node.set(split_attrib, "fill-stroke")
+
+    return [path_node if has_fill else None, path_node if has_stroke else None]
+
 def split_fill_and_stroke(path_node):
     """Split a path into two paths, one filled and one stroked
 
@@ -367,78 +1050,705 @@ def split_fill_and_stroke(path_node):
 
 ### Object related
 
-def propagate_attribs(node, parent_style={}, parent_transform=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]):
-    """Propagate style and transform to remove inheritance"""
+# Control point distance for approximating a quarter circle with a cubic bezier
+bezier_circle_k = 0.5522847498
+
+shape_attribs = {
+    "rect": ["x", "y", "width", "height", "rx", "ry"],
+    "circle": ["cx", "cy", "r"],
+    "ellipse": ["cx", "cy", "rx", "ry"],
+    "line": ["x1", "y1", "x2", "y2"],
+    "polyline": ["points"],
+    "polygon": ["points"]
+    }
+
+def _ellipse_path(cx, cy, rx, ry):
+    """Return a closed path (as a simplepath list) tracing an ellipse"""
+    kx = rx * bezier_circle_k
+    ky = ry * bezier_circle_k
+    return [
+        ["M", [cx+rx, cy]],
+        ["C", [cx+rx, cy+ky, cx+kx, cy+ry, cx, cy+ry]],
+        ["C", [cx-kx, cy+ry, cx-rx, cy+ky, cx-rx, cy]],
+        ["C", [cx-rx, cy-ky, cx-kx, cy-ry, cx, cy-ry]],
+        ["C", [cx+kx, cy-ry, cx+rx, cy-ky, cx+rx, cy]],
+        ["Z", []]
+        ]
+
+def _rect_path(x, y, w, h, rx, ry):
+    """Return a closed path (as a simplepath list) tracing a (rounded) rectangle"""
+    if rx <= 0 or ry <= 0:
+        return [
+            ["M", [x, y]],
+            ["L", [x+w, y]],
+            ["L", [x+w, y+h]],
+            ["L", [x, y+h]],
+            ["Z", []]
+            ]
 
-    # Don't enter non-graphical portions of the document
-    if (node.tag == addNS("namedview", "sodipodi")
-        or node.tag == addNS("defs", "svg")
-        or node.tag == addNS("metadata", "svg")
-        or node.tag == addNS("foreignObject", "svg")):
-        return
+    kx = rx * bezier_circle_k
+    ky = ry * bezier_circle_k
+    return [
+        ["M", [x+rx, y]],
+        ["L", [x+w-rx, y]],
+        ["C", [x+w-rx+kx, y, x+w, y+ry-ky, x+w, y+ry]],
+        ["L", [x+w, y+h-ry]],
+        ["C", [x+w, y+h-ry+ky, x+w-rx+kx, y+h, x+w-rx, y+h]],
+        ["L", [x+rx, y+h]],
+        ["C", [x+rx-kx, y+h, x, y+h-ry+ky, x, y+h-ry]],
+        ["L", [x, y+ry]],
+        ["C", [x, y+ry-ky, x+rx-kx, y, x+rx, y]],
+        ["Z", []]
+        ]
+
+def shape_to_path(node):
+    """Return the path data (as a simplepath list) of a basic SVG shape"""
+    tag = node.tag.split("}")[-1]
+    def dim(attrib):
+        return get_dimension(node.get(attrib, "0"))
+
+    if tag == "rect":
+        w = dim("width")
+        h = dim("height")
+        if w <= 0 or h <= 0:
+            return []
+
+        # A missing radius takes the value of the other one
+        rx = node.get("rx", node.get("ry"))
+        ry = node.get("ry", node.get("rx"))
+        rx = min(get_dimension(rx), w/2.0) if rx else 0
+        ry = min(get_dimension(ry), h/2.0) if ry else 0
+        return _rect_path(dim("x"), dim("y"), w, h, rx, ry)
+    elif tag == "circle":
+        r = dim("r")
+        if r <= 0:
+            return []
+        return _ellipse_path(dim("cx"), dim("cy"), r, r)
+    elif tag == "ellipse":
+        rx = dim("rx")
+        ry = dim("ry")
+        if rx <= 0 or ry <= 0:
+            return []
+        return _ellipse_path(dim("cx"), dim("cy"), rx, ry)
+    elif tag == "line":
+        return [["M", [dim("x1"), dim("y1")]], ["L", [dim("x2"), dim("y2")]]]
+    elif tag == "polyline" or tag == "polygon":
+        # Numbers need not be separated (e.g. "50-5"), so tokenize them like path data
+        points = node.get("points", "")
+        if path_number.sub("", points).strip(" \t\r\n,"):
+            raise MalformedSVGError, "Invalid points in %s: %s" % (tag, points)
+        coords = [float(c) for c in path_number.findall(points)]
+        if len(coords) % 2 != 0:
+            raise MalformedSVGError, "Odd number of coordinates in %s: %s" % (tag, points)
+        if len(coords) < 2:
+            return []
+        path = [["M", coords[0:2]]]
+        for i in range(2, len(coords) - 1, 2):
+            path.append(["L", coords[i:i+2]])
+        if tag == "polygon":
+            path.append(["Z", []])
+        return path
+    else:
+        raise MalformedSVGError, "Cannot convert %s to a path" % tag
 
+def shapes_to_paths(document):
+    """Convert basic shapes (rectangles, circles, lines, etc.) into paths in place
 
-    # Compose the transformations
-    if node.tag == addNS("svg", "svg") and node.get("viewBox"):
-        vx, vy, vw, vh = [get_dimension(x) for x in node.get("viewBox").split()]
-        dw = get_dimension(node.get("width", vw))
-        dh = get_dimension(node.get("height", vh))
-        t = "translate(%f, %f) scale(%f, %f)" % (-vx, -vy, dw/vw, dh/vh)
-        this_transform = simpletransform.parseTransform(t, parent_transform)
-        this_transform = simpletransform.parseTransform(node.get("transform"), this_transform)
-        del node.attrib["viewBox"]
-    else:
-        this_transform = simpletransform.parseTransform(node.get("transform"), parent_transform)
+    Returns the number of converted shapes.
+    """
+    xpath_cmd = " | ".join(["//svg:" + tag for tag in shape_attribs.keys()])
+    nodes = document.xpath(xpath_cmd, namespaces=NSS)
 
-    # Compose the style attribs
-    this_style = simplestyle.parseStyle(node.get("style", ""))
-    remaining_style = {} # Style attributes that are not propagated
+    for node in nodes:
+        tag = node.tag.split("}")[-1]
+        path_d = simplepath.formatPath(shape_to_path(node))
 
-    non_propagated = ["filter"] # Filters should remain on the topmost ancestor
-    for key in non_propagated:
-        if key in this_style.keys():
-            remaining_style[key] = this_style[key]
-            del this_style[key]
+        for attrib in shape_attribs[tag]:
+            if attrib in node.attrib:
+                del node.attrib[attrib]
+
+        node.tag = addNS("path", "svg")
+        node.set("d", path_d)
+
+    return len(nodes)
+
+def id_map(document):
+    """Return a dictionary of the elements of a document by id
+
+    The map is built in a single pass. If several elements share an id,
+    the first one is used.
+    """
+    ids = {}
+    for el in document.iter():
+        if not isinstance(el.tag, basestring):
+            # Comments and processing instructions
+            continue
+        el_id = el.get("id")
+        if el_id is not None and el_id not in ids:
+            ids[el_id] = el
+    return ids
 
-    # Create a copy of the parent style, and merge this style into it
-    parent_style_copy = parent_style.copy()
-    parent_style_copy.update(this_style)
-    this_style = parent_style_copy
+def expand_clones(document):
+    """Replace clones (<svg:use> elements) with copies of the objects they reference
+
+    Each referenced object is resolved once, including any clones nested in
+    it, and then copied for every clone that uses it.
+
+    Returns the number of expanded clones.
+    """
+    ids = id_map(document)
+    expanded = {}  # Resolved copies of referenced objects, by id
+    in_progress = []
+
+    def resolve(node):
+        """Expand all clones in a subtree, returning the new subtree root"""
+        if node.tag == addNS("use", "svg"):
+            return expand(node)
+        for use in node.xpath(".//svg:use", namespaces=NSS):
+            use.getparent().replace(use, expand(use))
+        return node
+
+    def expand(use):
+        """Return a group that replaces a single clone"""
+        href = use.get(addNS("href", "xlink"), "")
+        ref_id = href[1:]
+        if not href.startswith("#") or ref_id not in ids:
+            # Leave dangling clones alone, they will not be exported
+            return use
+
+        if ref_id not in expanded:
+            if ref_id in in_progress:
+                raise MalformedSVGError, "Clone of %s references itself" % ref_id
+            in_progress.append(ref_id)
+            expanded[ref_id] = resolve(deepcopy(ids[ref_id]))
+            in_progress.pop()
+
+        group = use.makeelement(addNS("g", "svg"))
+        for attrib_name in use.keys():
+            if attrib_name not in ["x", "y", "width", "height", "transform", addNS("href", "xlink")]:
+                group.set(attrib_name, use.get(attrib_name))
+
+        # The clone offset is applied after the clone's own transform
+        x = get_dimension(use.get("x", "0"))
+        y = get_dimension(use.get("y", "0"))
+        mtx = simpletransform.parseTransform(use.get("transform"))
+        mtx = simpletransform.composeTransform(mtx, [[1.0, 0.0, x], [0.0, 1.0, y]])
+        if mtx != [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]:
+            group.set("transform", simpletransform.formatTransform(mtx))
+
+        content = deepcopy(expanded[ref_id])
+        if content.tag == addNS("symbol", "svg"):
+            content.tag = addNS("g", "svg")
+
+        # Keep ids unique by prefixing them with the id of the clone
+        prefix = group.get("id", str(id(use)))
+        for el in content.xpath("descendant-or-self::*[@id]"):
+            el.set("id", "%s-%s" % (prefix, el.get("id")))
+
+        content.tail = None
+        group.append(content)
+        group.tail = use.tail
+        return group
+
+    uses = document.xpath("//svg:use", namespaces=NSS)
+    for use in uses:
+        parent = use.getparent()
+        if parent is not None:
+            parent.replace(use, expand(use))
+
+    return len(uses)
+
+def stash_clone_sources(document):
+    """Return copies of the objects referenced by clones, by id
+
+    The copies are taken before styles are propagated, because the contents
+    of a clone inherit their style from the clone, not from the original.
+    """
+    ids = id_map(document)
+    sources = {}
+    for use in document.xpath("//svg:use", namespaces=NSS):
+        href = use.get(addNS("href", "xlink"), "")
+        ref_id = href[1:]
+        if not href.startswith("#") or ref_id in sources:
+            continue
+        if ref_id in ids:
+            sources[ref_id] = deepcopy(ids[ref_id])
+    return sources
+
+def share_clones(document, sources):
+    """Prepare clones to be exported as shared canvases instead of copies
+
+    Every distinct (referenced object, clone style) pair becomes a group in an
+    svg2sif:clones container at the end of the document, propagated as if
+    it were the contents of the clone. Each clone is marked with the id of
+    its group (canvas_attrib), and keeps its own transform and offset.
+    Clones nested in the shared groups are handled the same way.
+
+    Returns the number of shared groups.
+    """
+    # Check for clones that reference themselves, directly or not
+    refs = {}
+    for ref_id, source in sources.iteritems():
+        refs[ref_id] = [use.get(addNS("href", "xlink"), "")[1:]
+                        for use in source.xpath("descendant-or-self::svg:use", namespaces=NSS)]
+    checked = set()
+    def check(ref_id, chain):
+        if ref_id in chain:
+            raise MalformedSVGError, "Clone of %s references itself" % ref_id
+        if ref_id in checked:
+            return
+        for child_id in refs.get(ref_id, []):
+            check(child_id, chain + [ref_id])
+        checked.add(ref_id)
+    for ref_id in refs.keys():
+        check(ref_id, [])
+
+    root = document.getroot()
+    container = root.makeelement(clones_tag)
+    root.append(container)
+
+    canvases = {}   # (referenced id, clone style) -> group id
+    pending = deque(document.xpath("//svg:use", namespaces=NSS))
+    while pending:
+        use = pending.popleft()
+        href = use.get(addNS("href", "xlink"), "")
+        ref_id = href[1:]
+        if not href.startswith("#") or ref_id not in sources:
+            # Leave dangling clones alone, they will not be exported
+            continue
 
-    # Merge in any attributes outside of the style
+        # Filters stay on the clone itself
+        style = simplestyle.parseStyle(use.get("style", ""))
+        if "filter" in style:
+            del style["filter"]
+        key = (ref_id, tuple(sorted(style.items())))
+
+        if key not in canvases:
+            group_id = "%s_%d" % (re.sub("[^A-Za-z0-9_]", "_", ref_id), len(canvases))
+            group = etree.SubElement(container, addNS("g", "svg"))
+            group.set("id", group_id)
+
+            content = deepcopy(sources[ref_id])
+            if content.tag == addNS("symbol", "svg"):
+                content.tag = addNS("g", "svg")
+            content.tail = None
+            group.append(content)
+
+            # Keep ids unique by prefixing them with the id of the group
+            for el in content.xpath("descendant-or-self::*[@id]"):
+                el.set("id", "%s-%s" % (group_id, el.get("id")))
+
+            propagate_attribs(group, style)
+            pending.extend(group.xpath(".//svg:use", namespaces=NSS))
+            canvases[key] = group_id
+
+        use.set(canvas_attrib, canvases[key])
+
+    return len(canvases)
+
+def propagate_attribs(node, parent_style={}, parent_transform=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]):
+    """Propagate style and transform to remove inheritance
+
+    The tree is walked with an explicit stack, so deep hierarchies do not
+    reach the recursion limit. Parsed styles, merged styles and composed
+    transforms are shared by all nodes that have the same ones.
+    """
+    skipped = [
+        addNS("namedview", "sodipodi"),
+        addNS("defs", "svg"),
+        addNS("metadata", "svg"),
+        addNS("foreignObject", "svg")
+        ]
+    containers = [
+        addNS("svg", "svg"),
+        addNS("g", "svg"),
+        addNS("a", "svg"),
+        addNS("switch", "svg")
+        ]
+    non_propagated = ["filter"] # Filters should remain on the topmost ancestor
     style_attribs = ["fill", "stroke"]
-    for attrib in style_attribs:
-        if node.get(attrib):
-            this_style[attrib] = node.get(attrib)
-            del node.attrib[attrib]
-
-    if (node.tag == addNS("svg", "svg")
-        or node.tag == addNS("g", "svg")
-        or node.tag == addNS("a", "svg")
-        or node.tag == addNS("switch", "svg")):
-        # Leave only non-propagating style attributes
-        if len(remaining_style) == 0:
-            if "style" in node.keys():
-                del node.attrib["style"]
+
+    parsed_styles = {}          # style attribute -> [style, remaining style]
+    merged_styles = {}          # (parent key, style attribute, attribs) -> [key, style]
+    formatted_styles = {}       # (style key, remaining style attribute) -> style attribute
+    composed_transforms = {}    # (parent key, transform attribute) -> [key, matrix]
+    formatted_transforms = {}   # transform key -> transform attribute
+
+    # Styles and transforms travel down the tree as [key, value] pairs,
+    # where equal keys mean equal values
+    stack = [(node, [0, parent_style], [0, parent_transform])]
+    next_key = [1]
+    def new_key():
+        next_key[0] += 1
+        return next_key[0]
+
+    svg_tag = addNS("svg", "svg")
+    while stack:
+        node, style_entry, transform_entry = stack.pop()
+
+        # Don't enter non-graphical portions of the document
+        tag = node.tag
+        if not isinstance(tag, basestring) or tag in skipped:
+            continue
+        node_attrib = node.attrib
+
+        # Compose the transformations
+        transform = node_attrib.get("transform")
+        if tag == svg_tag and node.get("viewBox"):
+            vx, vy, vw, vh = [get_dimension(x) for x in node.get("viewBox").split()]
+            dw = get_dimension(node.get("width", vw))
+            dh = get_dimension(node.get("height", vh))
+            t = "translate(%f, %f) scale(%f, %f)" % (-vx, -vy, dw/vw, dh/vh)
+            this_transform = simpletransform.parseTransform(t, transform_entry[1])
+            this_transform = simpletransform.parseTransform(transform, this_transform)
+            transform_entry = [new_key(), this_transform]
+            del node.attrib["viewBox"]
+        elif transform:
+            key = (transform_entry[0], transform)
+            if key not in composed_transforms:
+                composed_transforms[key] = [new_key(), simpletransform.parseTransform(transform, transform_entry[1])]
+            transform_entry = composed_transforms[key]
+
+        # Compose the style attribs
+        style_attrib = node_attrib.get("style", "")
+        if style_attrib not in parsed_styles:
+            this_style = simplestyle.parseStyle(style_attrib)
+            remaining_style = {} # Style attributes that are not propagated
+            for key in non_propagated:
+                if key in this_style.keys():
+                    remaining_style[key] = this_style[key]
+                    del this_style[key]
+            parsed_styles[style_attrib] = [this_style, remaining_style]
+        this_style, remaining_style = parsed_styles[style_attrib]
+
+        # Merge in any attributes outside of the style
+        attribs = tuple([node_attrib.get(attrib) for attrib in style_attribs])
+        for attrib, value in zip(style_attribs, attribs):
+            if value:
+                del node_attrib[attrib]
+
+        if this_style or any(attribs):
+            key = (style_entry[0], style_attrib, attribs)
+            if key not in merged_styles:
+                # Create a copy of the parent style, and merge this style into it
+                merged = style_entry[1].copy()
+                merged.update(this_style)
+                for attrib, value in zip(style_attribs, attribs):
+                    if value:
+                        merged[attrib] = value
+                merged_styles[key] = [new_key(), merged]
+            style_entry = merged_styles[key]
+
+        if tag in containers:
+            # Leave only non-propagating style attributes
+            if len(remaining_style) == 0:
+                if "style" in node_attrib:
+                    del node_attrib["style"]
+            else:
+                node.set("style", simplestyle.formatStyle(remaining_style))
+
+            # Remove the transform attribute
+            if transform is not None:
+                del node_attrib["transform"]
+
+            # Continue propagating on subelements, in document order
+            for c in reversed(node.getchildren()):
+                stack.append((c, style_entry, transform_entry))
         else:
-            node.set("style", simplestyle.formatStyle(remaining_style))
+            # This element is not a container
 
-        # Remove the transform attribute
-        if "transform" in node.keys():
-            del node.attrib["transform"]
+            # Merge remaining_style into the element's style
+            key = (style_entry[0], remaining_style.get("filter"))
+            if key not in formatted_styles:
+                leaf_style = style_entry[1].copy()
+                leaf_style.update(remaining_style)
+                formatted_styles[key] = simplestyle.formatStyle(leaf_style)
 
-        # Continue propagating on subelements
-        for c in node.iterchildren():
-            propagate_attribs(c, this_style, this_transform)
-    else:
-        # This element is not a container
+            if transform_entry[0] not in formatted_transforms:
+                formatted_transforms[transform_entry[0]] = simpletransform.formatTransform(transform_entry[1])
+
+            # Set the element's style and transform attribs
+            node.set("style", formatted_styles[key])
+            node.set("transform", formatted_transforms[transform_entry[0]])
+
+def path_bbox(path_d):
+    """Return a box [x0, y0, x1, y1] that contains a path, from its control points
+
+    Arcs are bounded by a box around their end point, large enough for the
+    whole ellipse. Returns None for empty paths.
+    """
+    xs = []
+    ys = []
+    px = py = 0.0
+    for cmd, params in iter_path(path_d):
+        if cmd == "A":
+            rx, ry, x, y = abs(params[0]), abs(params[1]), params[5], params[6]
+            r = 2 * max(rx, ry, math.hypot(x - px, y - py) / 2)
+            xs.extend([px, x - r, x + r])
+            ys.extend([py, y - r, y + r])
+            px, py = x, y
+        elif params:
+            xs.extend(params[0::2])
+            ys.extend(params[1::2])
+            px, py = params[-2:]
+    if not xs:
+        return None
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+def transform_bbox(mtx, box):
+    """Return the box that contains a transformed box"""
+    corners = [[box[0], box[1]], [box[2], box[1]], [box[0], box[3]], [box[2], box[3]]]
+    for corner in corners:
+        simpletransform.applyTransformToPoint(mtx, corner)
+    return [min([c[0] for c in corners]), min([c[1] for c in corners]),
+            max([c[0] for c in corners]), max([c[1] for c in corners])]
+
+def painted_bbox(node, style):
+    """Return a box that contains everything a prepared path paints, or None if it is empty
+
+    The box of the path is grown by its stroke (including miter joins), and
+    transformed with the path's transform.
+    """
+    box = path_bbox(node.get("d", ""))
+    if box is None:
+        return None
+
+    if style.get("stroke", "none") != "none":
+        grow = get_dimension(style.get("stroke-width", "1")) / 2
+        if style.get("stroke-linejoin", "miter") == "miter":
+            try:
+                miterlimit = float(style.get("stroke-miterlimit", "4"))
+            except ValueError:
+                # "inherit", or empty: use the initial value
+                miterlimit = 4.0
+            grow *= max(miterlimit, 1.5)
+        else:
+            grow *= 1.5
+        box = [box[0] - grow, box[1] - grow, box[2] + grow, box[3] + grow]
+
+    return transform_bbox(simpletransform.parseTransform(node.get("transform")), box)
+
+def cull_offcanvas(document, width, height):
+    """Remove objects that are entirely outside of the canvas, or not displayed
+
+    The bounding box of each path is computed from its control points, and
+    grown by its stroke. Groups are bounded by their children, so whole
+    subtrees outside of the canvas are removed at once. Filtered objects and
+    clones are always kept, as their extent is not known here.
 
-        # Merge remaining_style into this_style
-        this_style.update(remaining_style)
+    The document must have been prepared (transforms and styles propagated).
+    Returns the number of removed elements.
+    """
+    inf = float("inf")
+    empty = [inf, inf, -inf, -inf]      # Draws nothing
+    unknown = [-inf, -inf, inf, inf]    # May draw anywhere
+    containers = [
+        addNS("svg", "svg"),
+        addNS("g", "svg"),
+        addNS("a", "svg"),
+        addNS("switch", "svg")
+        ]
+    path_tag = addNS("path", "svg")
+
+    # Compute the boxes bottom-up (children come after their parents in
+    # document order, so they are seen first in reverse)
+    root = document.getroot()
+    boxes = {}
+    for node in reversed(list(root.iter())):
+        tag = node.tag
+        if not isinstance(tag, basestring):
+            continue
+        style = simplestyle.parseStyle(node.get("style", ""))
+
+        if style.get("display") == "none":
+            box = empty
+        elif "filter" in style.keys():
+            box = unknown
+        elif tag in containers:
+            box = empty
+            for child in node:
+                child_box = boxes.get(child, unknown)
+                box = [min(box[0], child_box[0]), min(box[1], child_box[1]),
+                       max(box[2], child_box[2]), max(box[3], child_box[3])]
+        elif tag == path_tag:
+            box = painted_bbox(node, style) or empty
+        else:
+            box = unknown
+        boxes[node] = box
+
+    # Remove the topmost subtrees that are outside of the canvas
+    removed = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for child in node.getchildren():
+            if not isinstance(child.tag, basestring) or child not in boxes:
+                continue
+            box = boxes[child]
+            if box[0] > width or box[1] > height or box[2] < 0 or box[3] < 0:
+                removed += len([el for el in child.iter() if isinstance(el.tag, basestring)])
+                node.remove(child)
+            elif child.tag in containers:
+                stack.append(child)
+    return removed
+
+def _opacity(style, attrib):
+    try:
+        return float(style.get(attrib, "1"))
+    except ValueError:
+        return 0.0
+
+def _plain(node, style):
+    """Return whether a node is drawn without filters, clipping, masks, blending or transparency"""
+    for attrib in ["filter", "clip-path", "mask"]:
+        if attrib in style.keys() or node.get(attrib) is not None:
+            return False
+    if style.get("mix-blend-mode", node.get("mix-blend-mode", "normal")).strip() != "normal":
+        return False
+    return _opacity(style, "opacity") >= 1.0
+
+def opaque_rect(node, style):
+    """Return the box of a prepared path if it is an opaque, axis-aligned rectangle, or None
+
+    Only plain, fully opaque solid fills count: anything with a filter, a
+    clip path, a mask, a blend mode, a gradient or transparency, on the
+    path or on any of its ancestors, is not considered opaque.
+    """
+    if style.get("fill", "#000000") in ["none", ""] or style.get("fill", "").startswith("url"):
+        return None
+    if not _plain(node, style) or _opacity(style, "fill-opacity") < 1.0:
+        return None
+    if style.get("display") == "none" or style.get("visibility", "visible") != "visible":
+        return None
+    for ancestor in node.iterancestors():
+        if not _plain(ancestor, simplestyle.parseStyle(ancestor.get("style", ""))):
+            return None
+
+    # A single subpath with four corners
+    corners = []
+    try:
+        for cmd, params in iter_path(node.get("d", "")):
+            if cmd == "M" and not corners or cmd == "L":
+                corners.append(params)
+            elif cmd != "Z":
+                return None
+    except MalformedSVGError:
+        return None
+    if len(corners) == 5 and corners[4] == corners[0]:
+        corners.pop()
+    if len(corners) != 4:
+        return None
+
+    mtx = simpletransform.parseTransform(node.get("transform"))
+    corners = [list(c) for c in corners]
+    for corner in corners:
+        simpletransform.applyTransformToPoint(mtx, corner)
+
+    # Every edge must be horizontal or vertical, and the corners must
+    # be the four different combinations of two x and two y values
+    eps = 1e-9
+    x0 = min([c[0] for c in corners])
+    x1 = max([c[0] for c in corners])
+    y0 = min([c[1] for c in corners])
+    y1 = max([c[1] for c in corners])
+    if x1 - x0 <= eps or y1 - y0 <= eps:
+        return None
+    combinations = []
+    for i in range(4):
+        a, b = corners[i], corners[(i+1) % 4]
+        if abs(a[0] - b[0]) > eps and abs(a[1] - b[1]) > eps:
+            return None
+        if abs(a[0] - x0) <= eps:
+            cx = 0
+        elif abs(a[0] - x1) <= eps:
+            cx = 1
+        else:
+            return None
+        if abs(a[1] - y0) <= eps:
+            cy = 0
+        elif abs(a[1] - y1) <= eps:
+            cy = 1
+        else:
+            return None
+        combinations.append((cx, cy))
+    if len(set(combinations)) != 4:
+        return None
+    return [x0, y0, x1, y1]
+
+def cull_occluded(document, width, height, margin=1.0):
+    """Remove paths that are entirely covered by a later opaque rectangle
+
+    Only axis-aligned rectangles with an opaque solid fill (see opaque_rect)
+    hide what is under them, and only paths that fit inside a single such
+    rectangle, shrunk by margin on every side, are removed. Nothing inside
+    a filtered, clipped, masked, blended or transparent group, or inside a
+    switch, takes part. Occluders are kept in a grid over the canvas.
+
+    The document must have been prepared (transforms and styles propagated).
+    Returns the number of removed paths.
+    """
+    containers = [
+        addNS("svg", "svg"),
+        addNS("g", "svg"),
+        addNS("a", "svg")
+        ]
+    path_tag = addNS("path", "svg")
+
+    # Collect the paths in paint order, with whether their ancestors are plain
+    paths = []
+    stack = [(document.getroot(), True)]
+    while stack:
+        node, plain = stack.pop()
+        if node.tag == path_tag:
+            paths.append((node, plain))
+            continue
 
-        # Set the element's style and transform attribs
-        node.set("style", simplestyle.formatStyle(this_style))
-        node.set("transform", simpletransform.formatTransform(this_transform))
+        style = simplestyle.parseStyle(node.get("style", ""))
+        if not _plain(node, style) or style.get("display") == "none":
+            plain = False
+        for child in reversed(node.getchildren()):
+            if child.tag in containers or child.tag == path_tag:
+                stack.append((child, plain))
+
+    # Grid of occluders over the canvas; occluders and queries are clamped
+    # to the grid, which keeps containment intact
+    cells = 32
+    cell_w = max(width, 1.0) / cells
+    cell_h = max(height, 1.0) / cells
+    def cell(x, y):
+        return (min(max(int(x // cell_w), 0), cells-1), min(max(int(y // cell_h), 0), cells-1))
+    grid = {}
+
+    # Walk backwards, from the topmost path down
+    removed = 0
+    for node, plain in reversed(paths):
+        if not plain:
+            continue
+        style = simplestyle.parseStyle(node.get("style", ""))
+
+        covered = False
+        if _plain(node, style):
+            box = painted_bbox(node, style)
+            if box is not None:
+                for occluder in grid.get(cell((box[0] + box[2]) / 2, (box[1] + box[3]) / 2), []):
+                    if (box[0] >= occluder[0] and box[1] >= occluder[1] and
+                        box[2] <= occluder[2] and box[3] <= occluder[3]):
+                        covered = True
+                        break
+        if covered:
+            node.getparent().remove(node)
+            removed += 1
+            continue
+
+        rect = opaque_rect(node, style)
+        if rect is not None:
+            occluder = [rect[0] + margin, rect[1] + margin, rect[2] - margin, rect[3] - margin]
+            if occluder[0] < occluder[2] and occluder[1] < occluder[3]:
+                (x0, y0), (x1, y1) = cell(occluder[0], occluder[1]), cell(occluder[2], occluder[3])
+                for x in range(x0, x1+1):
+                    for y in range(y0, y1+1):
+                        grid.setdefault((x, y), []).append(occluder)
+    return removed
 
 ### Style related
 
@@ -474,22 +1784,168 @@ def get_dimension(s="1024"):
 
 ###### Main Class #########################################
 class SynfigPrep(inkex.Effect):
-    def effect(self):
+    # Mark paths to be exported as a separate fill and stroke instead of
+    # splitting them, see mark_fill_and_stroke(). Only the exporter reads
+    # the marks, so prepared documents that are saved keep split paths.
+    mark_split = False
+
+    def __init__(self):
+        inkex.Effect.__init__(self)
+        self.OptionParser.add_option("--inkscape",
+                                     action="store", type="string",
+                                     dest="inkscape", default="inkscape",
+                                     help="Inkscape executable used to convert objects")
+        self.OptionParser.add_option("--inkscape-workers",
+                                     action="store", type="int",
+                                     dest="inkscape_workers", default=0,
+                                     help="Number of persistent Inkscape workers, for svg2sif_batch.py (0 to start Inkscape for every document)")
+        self.OptionParser.add_option("--inkscape-hand-off",
+                                     action="store", type="choice",
+                                     choices=["pipe", "shm", "file"],
+                                     dest="inkscape_hand_off", default="shm",
+                                     help="How to pass the document to Inkscape: pipe, shm or file")
+        self.OptionParser.add_option("--clones",
+                                     action="store", type="choice",
+                                     choices=["unlink", "canvas"],
+                                     dest="clones", default="unlink",
+                                     help="Export clones as copies (unlink) or as shared canvases (canvas)")
+
+        self.OptionParser.add_option("--cache-dir",
+                                     action="store", type="string",
+                                     dest="cache_dir", default="",
+                                     help="Directory to cache converted documents in (disabled if empty)")
+        self.OptionParser.add_option("--cache-size",
+                                     action="store", type="int",
+                                     dest="cache_size", default=64,
+                                     help="Maximum size of the cache, in megabytes")
+        self.OptionParser.add_option("--report",
+                                     action="store", type="inkbool",
+                                     dest="report", default=False,
+                                     help="Report conversion statistics")
+
+    def report(self, message):
+        """Show a message with conversion statistics, if requested"""
+        if self.options.report:
+            errormsg(message)
+
+    def get_worker_pool(self):
+        """Return the Inkscape worker pool to use, or None to start Inkscape on demand
+
+        Workers need an Inkscape that runs verbs in shell mode (0.x).
+        """
+        if self.options.inkscape_workers > 0:
+            if shell_verbs_supported(self.options.inkscape):
+                return get_worker_pool(self.options.inkscape_workers, self.options.inkscape)
+            self.report("Inkscape workers: shell mode does not run verbs in this Inkscape version")
+        return None
+
+    def get_cache(self):
+        """Return the document cache, or None if caching is disabled"""
+        if not self.options.cache_dir:
+            return None
+        if getattr(self, "cache", None) is None:
+            self.cache = DocumentCache(os.path.expanduser(self.options.cache_dir),
+                                       self.options.cache_size*1024*1024)
+        return self.cache
+
+    def cache_options(self):
+        """Return the option values that affect the converted document
+
+        Subclasses add the options of their own conversion, but the
+        prepared document is only keyed on these (see prepare_document).
+        """
+        return ["clones=%s" % self.options.clones,
+                "split=%s" % ("mark" if self.mark_split else "split")]
+
+    def cache_key(self, kind, options=None):
+        """Return the cache key of the input document for a given conversion
+
+        options defaults to cache_options().
+        """
+        if options is None:
+            options = self.cache_options()
+        svg_file = getattr(self, "svg_file", None)
+        if svg_file and os.path.isfile(svg_file):
+            stream = open(svg_file, "rb")
+            data = stream.read()
+            stream.close()
+        else:
+            data = etree.tostring(self.document)
+        return self.get_cache().key(data, [kind] + options)
+
+    def report_cache(self):
+        cache = self.get_cache()
+        if cache is not None:
+            self.report("Cache: %(hits)d hits, %(misses)d misses (hit ratio %(hit_ratio).2f), "
+                        "%(evictions)d evictions, %(entries)d entries, %(size)d bytes" % cache.stats())
+
+    def prepare_document(self):
+        """Prepare the document, or fetch the prepared document from the cache"""
+        cache = self.get_cache()
+        if cache is not None:
+            # Export options do not change the prepared document
+            key = self.cache_key("svg", SynfigPrep.cache_options(self))
+            data = cache.get(key, "svg")
+            if data is not None:
+                self.document = etree.fromstring(data).getroottree()
+                return
+
+        self.prepare()
+
+        if cache is not None:
+            cache.put(key, "svg", etree.tostring(self.document))
+
+    def prepare(self):
         """Transform document in preparation for exporting it into the Synfig format"""
 
-        a = SynfigExportActionGroup(self.document)
-        self.document = a.run_document()
+        # Find out which stages have something to do
+        self.summary = DocumentSummary(self.document)
+        self.report("Document: %s" % self.summary)
+
+        # Unlink clones and convert basic shapes without calling Inkscape,
+        # so that the subprocess only runs when the document contains text
+        share = self.options.clones == "canvas" and self.summary.clones > 0
+        if self.summary.clones and not share:
+            expand_clones(self.document)
+        if self.summary.shapes:
+            shapes_to_paths(self.document)
+
+        if self.summary.needs_inkscape():
+            a = SynfigExportActionGroup(self.document, self.get_worker_pool(),
+                                        self.options.inkscape, self.options.inkscape_hand_off,
+                                        unlink_clones=not share)
+            self.document = a.run_document()
+
+        # Shared clones are propagated with the style of each clone,
+        # so the objects they reference are copied before propagation
+        if share:
+            sources = stash_clone_sources(self.document)
 
         # Remove inheritance of attributes
-        propagate_attribs(self.document.getroot())
+        if self.summary.needs_propagation():
+            propagate_attribs(self.document.getroot())
+
+        if share:
+            canvases = share_clones(self.document, sources)
+            self.report("Clones: %d clones share %d canvases" % (self.summary.clones, canvases))
 
         # Fuse multiple subpaths in fills
-        for node in self.document.xpath('//svg:path', namespaces=NSS):
-            if node.get("d", "").lower().count("m") > 1:
-                # There are multiple subpaths
-                fill = split_fill_and_stroke(node)[0]
-                if fill is not None:
-                    fuse_subpaths(fill)
+        if self.summary.needs_fusing():
+            for node in self.document.xpath('//svg:path', namespaces=NSS):
+                if node.get("d", "").lower().count("m") > 1:
+                    # There are multiple subpaths
+                    if self.mark_split:
+                        fill, stroke = mark_fill_and_stroke(node)
+                        if fill is not None and stroke is None:
+                            fuse_subpaths(fill)
+                    else:
+                        fill = split_fill_and_stroke(node)[0]
+                        if fill is not None:
+                            fuse_subpaths(fill)
+
+    def effect(self):
+        self.prepare_document()
+        self.report_cache()
 
 if __name__ == '__main__':
     try:
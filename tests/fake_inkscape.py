@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+fake_inkscape.py
+A stand-in for Inkscape 0.x, for testing without Inkscape
+
+It understands the command lines that the exporter sends, either as
+arguments or one per line in shell mode (--shell), and implements just
+enough of them: ObjectToPath replaces the selected objects with a square
+path, EditUnlinkClone replaces the selected clones with empty groups and
+FileSave writes the document back.
+
+Every start of the program and every command it runs is appended to the
+file named by FAKE_INKSCAPE_LOG, and --version prints FAKE_INKSCAPE_VERSION.
+
+Copyright (C) 2011 Nikita Kitaev
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+"""
+import os
+import sys
+import shlex
+
+from lxml import etree
+
+svg_ns = "http://www.w3.org/2000/svg"
+
+def log(message):
+    filename = os.environ.get("FAKE_INKSCAPE_LOG")
+    if filename:
+        f = open(filename, "a")
+        f.write(message + "\n")
+        f.close()
+
+def run(args):
+    """Run a single command line"""
+    log("command " + " ".join(args))
+    filename = None
+    document = None
+    selection = []
+    for arg in args:
+        if not arg.startswith("--"):
+            filename = arg
+            document = etree.parse(filename)
+        elif arg.startswith("--select="):
+            selection.extend(document.xpath("//*[@id='%s']" % arg[len("--select="):]))
+        elif arg == "--verb=EditDeselect":
+            selection = []
+        elif arg == "--verb=ObjectToPath":
+            for node in selection:
+                path = etree.Element("{%s}path" % svg_ns)
+                path.set("id", node.get("id"))
+                path.set("d", "M 0,0 L 10,0 L 10,10 L 0,10 Z")
+                if node.get("style") is not None:
+                    path.set("style", node.get("style"))
+                node.getparent().replace(node, path)
+            selection = []
+        elif arg == "--verb=EditUnlinkClone":
+            for node in selection:
+                group = etree.Element("{%s}g" % svg_ns)
+                group.set("id", node.get("id"))
+                node.getparent().replace(node, group)
+            selection = []
+        elif arg == "--verb=FileSave":
+            document.write(filename)
+
+if __name__ == '__main__':
+    log("start " + " ".join(sys.argv[1:]))
+    if "--version" in sys.argv:
+        print "Inkscape %s" % os.environ.get("FAKE_INKSCAPE_VERSION", "0.48.5 r10040")
+    elif "--shell" in sys.argv:
+        while True:
+            sys.stdout.write("\n>")
+            sys.stdout.flush()
+            line = sys.stdin.readline()
+            if not line or line.strip() == "quit":
+                break
+            run(shlex.split(line))
+    else:
+        run(sys.argv[1:])
+
+# vim: expandtab shiftwidth=4 tabstop=8 softtabstop=4 fileencoding=utf-8 textwidth=99
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+test_batch.py
+Tests of svg2sif_batch.py, run against a stand-in for Inkscape
+
+Usage: python -m unittest discover tests
+
+Like svg2sif_batch.py, this needs the Inkscape extension directory
+(inkex.py, simplepath.py, ...) on PYTHONPATH.
+
+Copyright (C) 2011 Nikita Kitaev
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+"""
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from lxml import etree
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(tests_dir)
+
+document_template = """<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100">
+  <text id="text%(n)d" x="10" y="50" style="fill:#ff0000">Text %(n)d</text>
+</svg>
+"""
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "inkscape.log")
+
+        # A script, so that it can be started without a shell like Inkscape
+        self.inkscape = os.path.join(self.dir, "inkscape")
+        f = open(self.inkscape, "w")
+        f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(tests_dir, "fake_inkscape.py")))
+        f.close()
+        os.chmod(self.inkscape, stat.S_IRWXU)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def convert(self, count, args, version=None):
+        """Convert count documents with svg2sif_batch.py, returning the Inkscape log"""
+        filenames = []
+        for n in range(count):
+            filename = os.path.join(self.dir, "doc%d.svg" % n)
+            f = open(filename, "w")
+            f.write(document_template % {"n": n})
+            f.close()
+            filenames.append(filename)
+
+        env = dict(os.environ)
+        env["FAKE_INKSCAPE_LOG"] = self.log
+        env["PYTHONPATH"] = os.pathsep.join([package_dir] + env.get("PYTHONPATH", "").split(os.pathsep))
+        if version is not None:
+            env["FAKE_INKSCAPE_VERSION"] = version
+
+        cmd = [sys.executable, os.path.join(package_dir, "svg2sif_batch.py"),
+               "--inkscape=%s" % self.inkscape] + args + filenames
+        self.assertEqual(subprocess.call(cmd, env=env), 0)
+
+        for filename in filenames:
+            sif = etree.parse(os.path.splitext(filename)[0] + ".sif")
+            self.assertEqual(len(sif.xpath("//layer[@type='region']")), 1)
+
+        f = open(self.log)
+        lines = f.read().splitlines()
+        f.close()
+        return lines
+
+    def starts(self, lines, arg):
+        return [line for line in lines if line.startswith("start") and arg in line.split()]
+
+    def commands(self, lines):
+        return [line for line in lines if line.startswith("command")]
+
+    def test_single_worker(self):
+        lines = self.convert(3, [])
+        self.assertEqual(len(self.starts(lines, "--shell")), 1)
+        self.assertEqual(len(self.commands(lines)), 3)
+        for line in self.commands(lines):
+            self.assertTrue("--verb=FileClose" in line.split())
+
+    def test_worker_pool(self):
+        lines = self.convert(6, ["--inkscape-workers=2"])
+        self.assertTrue(1 <= len(self.starts(lines, "--shell")) <= 2)
+        self.assertEqual(len(self.commands(lines)), 6)
+
+    def test_no_workers(self):
+        lines = self.convert(2, ["--inkscape-workers=0"])
+        self.assertEqual(len(self.starts(lines, "--shell")), 0)
+        self.assertEqual(len(self.commands(lines)), 2)
+
+    def test_inkscape_1(self):
+        # Inkscape 1.x shell mode does not run verbs: start it for each document
+        lines = self.convert(2, [], version="1.0.2 (e86c870879, 2021-01-15)")
+        self.assertEqual(len(self.starts(lines, "--shell")), 0)
+        self.assertEqual(len(self.commands(lines)), 2)
+        for line in self.commands(lines):
+            self.assertTrue("--verb=FileQuit" in line.split())
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab shiftwidth=4 tabstop=8 softtabstop=4 fileencoding=utf-8 textwidth=99
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_guids.py
+Tests of the GUID strategies of the Synfig exporter
+
+Usage: python -m unittest discover tests
+
+Like svg2sif_batch.py, this needs the Inkscape extension directory
+(inkex.py, simplepath.py, ...) on PYTHONPATH.
+
+Copyright (C) 2011 Nikita Kitaev
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(tests_dir)
+sys.path.insert(0, package_dir)
+
+from synfig_output import SynfigDocument
+
+document = u"""<svg xmlns="http://www.w3.org/2000/svg"
+     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="100" height="100">
+  <g id="слой1" inkscape:label="Слой 1" inkscape:groupmode="layer">
+    <path id="путь1" d="M 10,10 L 50,10 L 50,50 Z" style="fill:#ff0000;stroke:#000000"/>
+  </g>
+</svg>
+"""
+
+class GuidTest(unittest.TestCase):
+    def test_hash(self):
+        guids = []
+        for i in range(2):
+            d = SynfigDocument(guids="hash", guid_seed="seed")
+            guids.append([d.new_guid("bline", u"путь1"), d.new_guid("bline", u"путь1"),
+                          d.new_guid("layer", u"Слой 1"), d.new_guid("layer", "path1")])
+        self.assertEqual(guids[0], guids[1])
+        self.assertEqual(len(set(guids[0])), 4)
+
+    def test_hash_export(self):
+        # Converting the same document twice gives the same GUIDs
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "doc.svg")
+            f = open(filename, "w")
+            f.write(document.encode("utf-8"))
+            f.close()
+
+            env = dict(os.environ)
+            env["PYTHONPATH"] = os.pathsep.join([package_dir] + env.get("PYTHONPATH", "").split(os.pathsep))
+            cmd = [sys.executable, os.path.join(package_dir, "synfig_output.py"), "--guids=hash", filename]
+            outputs = [subprocess.Popen(cmd, stdout=subprocess.PIPE, env=env).communicate()[0] for i in range(2)]
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertTrue("guid=" in outputs[0])
+        self.assertEqual(outputs[0], outputs[1])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab shiftwidth=4 tabstop=8 softtabstop=4 fileencoding=utf-8 textwidth=99